@@ -1,21 +1,20 @@
 import os
 import time
-import json
-import base64
-import requests
-import pyautogui
 import threading
-import datetime
-from tkinter import messagebox, scrolledtext
-import tempfile
-from PIL import Image, ImageTk
-from gtts import gTTS
-from playsound import playsound
-import langdetect
+import queue
+import collections
+import zipfile
+import logging
+import logging.handlers
+from tkinter import messagebox, scrolledtext, filedialog
 
 # Import the CustomTkinter library
 import customtkinter as ctk
 
+# The agent itself lives in aiport_engine.py, which also runs it without this window
+from aiport_engine import (AgentEngine, UsageTracker, ReplaySession, CACHE_DIR, PROVIDER_MODELS, TIMING_PROFILES,
+                           HEDGE_SETTINGS, RECORDING_SETTINGS, METRICS_SETTINGS)
+
 # One UI-like color palette
 ONEUI_COLORS = {
     "primary": "#4a85fa",
@@ -25,86 +24,33 @@ ONEUI_COLORS = {
     "widget_bg": "#2a2a2a"
 }
 
+# Log lines are shown in batches "frame_rate" times per second and the log view keeps only the
+# last "max_lines" lines; the full log is written to a rotating file under CACHE_DIR.
+LOG_SETTINGS = {
+    "max_lines": 2000,
+    "frame_rate": 20,
+    "file_path": os.path.join(CACHE_DIR, "logs", "aiport.log"),
+    "max_file_bytes": 5 * 1024 * 1024,
+    "backup_count": 3
+}
+
 ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("blue")
 
-class UsageMonitor:
-    """Manages tracking, displaying, and logging AI usage and costs."""
+class UsageMonitor(UsageTracker):
+    """Shows the tracked AI usage and costs in a window."""
     
     def __init__(self, root):
+        super().__init__()
         self.root = root
-        self.start_time = None
-        self.total_tokens_in = 0
-        self.total_tokens_out = 0
-        self.total_requests = 0
-        self.current_model = ""
-        self.is_running = False
         self.update_job = None
-
-        # Estimated prices per 1 million tokens (in USD) and RPM limits
-        # These are estimates and may be subject to change.
-        self.PRICES = {
-            "gpt-4o": {"in": 5.0, "out": 15.0, "rpm": 60},
-            "gemini-2.5-flash": {"in": 0.35, "out": 1.05, "rpm": 20},
-            "claude-3-5-sonnet-20240620": {"in": 3.0, "out": 15.0, "rpm": 40},
-            "llama3": {"in": 0, "out": 0, "rpm": 90},  # Free for local usage
-            "phi3": {"in": 0, "out": 0, "rpm": 90},    # Free for local usage
-            "default": {"in": 0, "out": 0, "rpm": 30}
-        }
-        
         self.usage_window = None
 
-    def start_tracking(self, model):
-        self.start_time = time.time()
-        self.current_model = model
-        self.total_tokens_in = 0
-        self.total_tokens_out = 0
-        self.total_requests = 0
-        self.is_running = True
-
     def stop_tracking(self):
-        self.is_running = False
+        super().stop_tracking()
         if self.usage_window and self.usage_window.winfo_exists() and self.update_job:
             self.root.after_cancel(self.update_job)
 
-    def update_tokens(self, tokens_in, tokens_out):
-        self.total_tokens_in += tokens_in
-        self.total_tokens_out += tokens_out
-        self.total_requests += 1
-
-    def _get_model_price(self):
-        return self.PRICES.get(self.current_model, self.PRICES["default"])
-
-    def _calculate_costs(self):
-        prices = self._get_model_price()
-        
-        current_cost = (self.total_tokens_in / 1_000_000) * prices["in"] + \
-                       (self.total_tokens_out / 1_000_000) * prices["out"]
-        
-        uptime = time.time() - self.start_time if self.start_time else 0
-        
-        if uptime > 0:
-            avg_hourly_cost = current_cost / (uptime / 3600)
-            avg_daily_cost = current_cost / (uptime / 86400)
-        else:
-            avg_hourly_cost = 0
-            avg_daily_cost = 0
-
-        return {
-            "current_cost": current_cost,
-            "hourly": avg_hourly_cost,
-            "daily": avg_daily_cost
-        }
-
-    def _calculate_stats(self):
-        uptime = time.time() - self.start_time if self.start_time else 0
-        rpm = (self.total_requests / uptime * 60) if uptime > 0 else 0
-        
-        return {
-            "uptime": uptime,
-            "rpm": rpm
-        }
-
     def _show_usage_window_internal(self):
         if self.usage_window and self.usage_window.winfo_exists():
             self.usage_window.lift()
@@ -112,12 +58,13 @@ class UsageMonitor:
             
         self.usage_window = ctk.CTkToplevel(self.root)
         self.usage_window.title("AI Usage & Costs")
-        self.usage_window.geometry("450x450")
+        self.usage_window.geometry("520x640")
         self.usage_window.configure(fg_color=ONEUI_COLORS["dark_bg"])
         self.usage_window.transient(self.root)
         self.usage_window.grab_set()
 
-        main_frame = ctk.CTkFrame(self.usage_window, fg_color=ONEUI_COLORS["widget_bg"])
+        # Scrolls, so the window fits on 768 px screens however many sections it grows
+        main_frame = ctk.CTkScrollableFrame(self.usage_window, fg_color=ONEUI_COLORS["widget_bg"])
         main_frame.pack(fill="both", expand=True, padx=15, pady=15)
         
         ctk.CTkLabel(main_frame, text="Current Usage & Costs", font=("Roboto", 16, "bold"), text_color=ONEUI_COLORS["text"]).pack(pady=(10, 20))
@@ -132,6 +79,21 @@ class UsageMonitor:
         self.tokens_label = ctk.CTkLabel(main_frame, text="Tokens Used: 0 In / 0 Out", text_color=ONEUI_COLORS["text"])
         self.tokens_label.pack(anchor="w", padx=20, pady=5)
 
+        self.skipped_label = ctk.CTkLabel(main_frame, text="Skipped Calls (screen unchanged): 0", text_color=ONEUI_COLORS["text"])
+        self.skipped_label.pack(anchor="w", padx=20, pady=5)
+
+        self.cache_label = ctk.CTkLabel(main_frame, text="Prompt Cache: 0 hits / 0 misses (0 cached tokens)", text_color=ONEUI_COLORS["text"])
+        self.cache_label.pack(anchor="w", padx=20, pady=5)
+
+        self.response_cache_label = ctk.CTkLabel(main_frame, text="Response Cache: 0 hits ($0.0000 saved)", text_color=ONEUI_COLORS["text"])
+        self.response_cache_label.pack(anchor="w", padx=20, pady=5)
+
+        self.hedge_label = ctk.CTkLabel(main_frame, text="Hedged Requests: 0 sent, 0 won ($0.0000 extra)", text_color=ONEUI_COLORS["text"])
+        self.hedge_label.pack(anchor="w", padx=20, pady=5)
+
+        self.cascade_label = ctk.CTkLabel(main_frame, text="Cascade: 0 steps", text_color=ONEUI_COLORS["text"])
+        self.cascade_label.pack(anchor="w", padx=20, pady=5)
+
         # Costs Labels
         self.cost_label = ctk.CTkLabel(main_frame, text="Current Cost: $0.00", font=("Roboto", 12, "bold"), text_color=ONEUI_COLORS["primary"])
         self.cost_label.pack(anchor="w", padx=20, pady=(15, 5))
@@ -145,18 +107,69 @@ class UsageMonitor:
         self.model_limit_label = ctk.CTkLabel(main_frame, text=f"RPM Limit for {self.current_model}: {self._get_model_price()['rpm']}", text_color=ONEUI_COLORS["text"])
         self.model_limit_label.pack(anchor="w", padx=20, pady=(15, 5))
 
+        self.budget_label = ctk.CTkLabel(main_frame, text="Budget: not set", text_color=ONEUI_COLORS["text"])
+        self.budget_label.pack(anchor="w", padx=20, pady=5)
+
+        # History from the usage ledger
+        ctk.CTkLabel(main_frame, text="History", font=("Roboto", 14, "bold"), text_color=ONEUI_COLORS["text"]).pack(anchor="w", padx=20, pady=(15, 5))
+        self.history_label = ctk.CTkLabel(main_frame, text="", justify="left", font=("TkFixedFont", 11), text_color=ONEUI_COLORS["text"])
+        self.history_label.pack(anchor="w", padx=20, pady=5)
+        self.history_updated = 0
+
+        ctk.CTkLabel(main_frame, text="Stage latency (p50 / p95 / p99)", font=("Roboto", 14, "bold"), text_color=ONEUI_COLORS["text"]).pack(anchor="w", padx=20, pady=(15, 5))
+        self.latency_label = ctk.CTkLabel(main_frame, text="", justify="left", font=("TkFixedFont", 11), text_color=ONEUI_COLORS["text"])
+        self.latency_label.pack(anchor="w", padx=20, pady=5)
+
         # Close button
-        close_button = ctk.CTkButton(main_frame, text="Close & Save", command=self._save_data_and_close)
-        close_button.pack(pady=(20, 10))
+        export_button = ctk.CTkButton(main_frame, text="Export Metrics", command=self._export_metrics)
+        export_button.pack(pady=(20, 5))
+
+        close_button = ctk.CTkButton(main_frame, text="Close", command=self._close_window)
+        close_button.pack(pady=(5, 10))
         
         self.update_stats()
-        self.usage_window.protocol("WM_DELETE_WINDOW", self._save_data_and_close)
+        self.usage_window.protocol("WM_DELETE_WINDOW", self._close_window)
 
-    def _save_data_and_close(self):
-        self._save_daily_usage()
+    def _close_window(self):
         if self.usage_window and self.usage_window.winfo_exists():
             self.usage_window.destroy()
 
+    def _export_metrics(self):
+        try:
+            self.latency.export(METRICS_SETTINGS["export_dir"])
+            messagebox.showinfo("Metrics", f"Metrics written to {METRICS_SETTINGS['export_dir']}", parent=self.usage_window)
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not export metrics.\nError: {e}", parent=self.usage_window)
+
+    def _cascade_text(self):
+        if not self.routing:
+            return "Cascade: 0 steps"
+        served = collections.Counter(decision["served_by"] for decision in self.routing)
+        escalations = sum(len(decision["tried"]) - 1 for decision in self.routing)
+        models = ", ".join(f"{model} {count}" for model, count in served.most_common())
+        return f"Cascade: {len(self.routing)} steps ({models}), {escalations} escalations, ${self.cascade_saved:.4f} saved"
+
+    def _latency_text(self):
+        lines = []
+        for entry in self.latency.snapshot():
+            if entry["model"] != self.current_model:
+                continue
+            lines.append(f"  {entry['stage']:<9} {entry['p50'] * 1000:>8.1f} {entry['p95'] * 1000:>8.1f} {entry['p99'] * 1000:>8.1f} ms  ({entry['count']})")
+        return "\n".join(lines) or "  No samples yet"
+
+    def _history_text(self):
+        lines = ["Today by model:"]
+        for model, requests_count, tokens, cost, latency in self.ledger.per_model():
+            lines.append(f"  {model[:28]:<28} {requests_count:>5} req {tokens:>9} tok ${cost:.4f} {latency:.2f}s avg")
+        lines.append("Last 7 days:")
+        for day, requests_count, tokens, cost in self.ledger.per_day():
+            lines.append(f"  {day} {requests_count:>5} req {tokens:>9} tok ${cost:.4f}")
+        lines.append("Recent tasks:")
+        for prompt, requests_count, tokens, cost in self.ledger.per_task():
+            prompt = " ".join((prompt or "").split())
+            lines.append(f"  {prompt[:28]:<28} {requests_count:>5} req {tokens:>9} tok ${cost:.4f}")
+        return "\n".join(lines)
+
     def update_stats(self):
         if not self.usage_window or not self.usage_window.winfo_exists():
             return
@@ -167,50 +180,85 @@ class UsageMonitor:
         self.uptime_label.configure(text=f"AI Uptime: {stats['uptime']:.1f}s")
         self.rpm_label.configure(text=f"RPM: {stats['rpm']:.2f}")
         self.tokens_label.configure(text=f"Tokens Used: {self.total_tokens_in} In / {self.total_tokens_out} Out")
+        self.skipped_label.configure(text=f"Skipped Calls (screen unchanged): {self.skipped_requests}")
+        self.cache_label.configure(text=f"Prompt Cache: {self.cache_hits} hits / {self.total_requests - self.cache_hits} misses ({self.total_cached_tokens} cached tokens)")
+        self.response_cache_label.configure(text=f"Response Cache: {self.response_cache_hits} hits (${self.response_cache_saved:.4f} saved)")
+        self.hedge_label.configure(text=f"Hedged Requests: {self.hedged_requests} sent, {self.hedge_wins} won (${self.hedge_cost:.4f} extra)")
+        self.cascade_label.configure(text=self._cascade_text())
         self.cost_label.configure(text=f"Current Cost: ${costs['current_cost']:.4f}")
         self.hourly_cost_label.configure(text=f"Est. Hourly Cost: ${costs['hourly']:.4f}")
         self.daily_cost_label.configure(text=f"Est. Daily Cost: ${costs['daily']:.4f}")
         self.model_limit_label.configure(text=f"RPM Limit for {self.current_model}: {self._get_model_price()['rpm']}")
+        if self.budget is not None:
+            self.budget_label.configure(text=self.budget.describe())
+        self.latency_label.configure(text=self._latency_text())
+        if time.time() - self.history_updated >= 5:
+            self.history_label.configure(text=self._history_text())
+            self.history_updated = time.time()
         
         if self.is_running:
             self.update_job = self.root.after(1000, self.update_stats)
 
-    def _save_daily_usage(self):
-        # Path to the data file
-        file_path = "money_usage.json"
-        
-        # Load existing data or initialize a new dictionary
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            data = {}
-        
-        today = datetime.date.today().isoformat()
-        
-        # Prepare today's data entry
-        costs = self._calculate_costs()
-        stats = self._calculate_stats()
-        
-        today_entry = {
-            "model": self.current_model,
-            "tokens_in": self.total_tokens_in,
-            "tokens_out": self.total_tokens_out,
-            "total_requests": self.total_requests,
-            "uptime_seconds": stats['uptime'],
-            "current_cost_usd": costs['current_cost'],
-            "hourly_cost_est_usd": costs['hourly'],
-            "daily_cost_est_usd": costs['daily']
-        }
-        
-        data[today] = today_entry
-        
-        # Save the updated data
+class LogSink:
+    """Collects log lines from any thread and shows them in a Tk text widget in batches."""
+
+    def __init__(self, root, widget, max_lines=2000, frame_rate=20, file_path=None, max_file_bytes=5 * 1024 * 1024, backup_count=3):
+        self.root = root
+        self.widget = widget
+        self.max_lines = max_lines
+        self.frame_interval = max(1, 1000 // frame_rate)
+        # deque.append/popleft are atomic, so writers never block on the UI
+        self.pending = collections.deque()
+        self.listener = None
+        if file_path:
+            # The full log goes to a rotating file from a background thread
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(file_path, maxBytes=max_file_bytes, backupCount=backup_count, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.file_queue = queue.SimpleQueue()
+            self.file_logger = logging.getLogger(f"aiport.log.{id(self)}")
+            self.file_logger.propagate = False
+            self.file_logger.setLevel(logging.INFO)
+            self.file_logger.addHandler(logging.handlers.QueueHandler(self.file_queue))
+            self.listener = logging.handlers.QueueListener(self.file_queue, handler)
+            self.listener.start()
+        self.root.after(self.frame_interval, self._drain)
+
+    def write(self, message):
+        self.pending.append(message)
+        if self.listener is not None:
+            self.file_logger.info(message)
+
+    def clear(self):
+        # Main thread only
+        self.pending.clear()
+        self.widget.configure(state="normal")
+        self.widget.delete("1.0", "end")
+        self.widget.configure(state="disabled")
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def _drain(self):
+        # Runs on the Tk main loop once per frame and inserts everything queued since the last frame
+        lines = []
         try:
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=4)
-        except Exception as e:
-            print(f"Error saving daily usage data: {e}")
+            while True:
+                lines.append(self.pending.popleft())
+        except IndexError:
+            pass
+        if lines:
+            self.widget.configure(state="normal")
+            self.widget.insert("end", "\n".join(lines) + "\n")
+            # Keep only the newest max_lines lines
+            line_count = int(self.widget.index("end-1c").split(".")[0]) - 1
+            if line_count > self.max_lines:
+                self.widget.delete("1.0", f"{line_count - self.max_lines + 1}.0")
+            self.widget.configure(state="disabled")
+            self.widget.see("end")
+        self.root.after(self.frame_interval, self._drain)
 
 class AIportGUI:
     def __init__(self, root):
@@ -222,18 +270,17 @@ class AIportGUI:
         self.api_key = ctk.StringVar()
         self.api_provider = ctk.StringVar(value="Ollama")
         self.model = ctk.StringVar()
-        self.stop_flag = False
         self.agent_thread = None
-        self.last_screenshot_path = None
-        self.tutorial_content = None
-        self.cursor_image = None
         self.usage_monitor = UsageMonitor(self.root)
-        
-        # Cố gắng tải hình ảnh con trỏ chuột
-        try:
-            self.cursor_image = Image.open("cursor.png").convert("RGBA")
-        except FileNotFoundError:
-            messagebox.showwarning("Warning", "File 'cursor.png' not found. Screenshots will be taken without a cursor.")
+        self.diff_mode = ctk.BooleanVar(value=False)
+        self.stream_mode = ctk.BooleanVar(value=False)
+        self.settle_mode = ctk.BooleanVar(value=False)
+        self.timing_profile = ctk.StringVar(value="human")
+        self.record_mode = ctk.BooleanVar(value=False)
+        self.response_cache_mode = ctk.BooleanVar(value=False)
+        self.macro_mode = ctk.BooleanVar(value=False)
+        self.hedge_mode = ctk.BooleanVar(value=False)
+        self.cascade_mode = ctk.BooleanVar(value=False)
 
         main_frame = ctk.CTkFrame(root, fg_color=ONEUI_COLORS["dark_bg"], corner_radius=10)
         main_frame.pack(fill="both", expand=True, padx=20, pady=20)
@@ -253,6 +300,34 @@ class AIportGUI:
         self.model_combobox.set("llama3")
         self.model_combobox.pack(fill="x", pady=(0, 15))
 
+        self.diff_mode_checkbox = ctk.CTkCheckBox(main_frame, text="Send only changed screen regions", variable=self.diff_mode, text_color=ONEUI_COLORS["text"])
+        self.diff_mode_checkbox.pack(anchor="w", pady=(0, 5))
+
+        self.stream_mode_checkbox = ctk.CTkCheckBox(main_frame, text="Stream responses and execute actions as they arrive", variable=self.stream_mode, text_color=ONEUI_COLORS["text"])
+        self.stream_mode_checkbox.pack(anchor="w", pady=(0, 5))
+
+        self.settle_mode_checkbox = ctk.CTkCheckBox(main_frame, text="Wait for the screen to settle instead of fixed delays", variable=self.settle_mode, text_color=ONEUI_COLORS["text"])
+        self.settle_mode_checkbox.pack(anchor="w", pady=(0, 5))
+
+        self.response_cache_checkbox = ctk.CTkCheckBox(main_frame, text="Reuse responses for screens seen before", variable=self.response_cache_mode, text_color=ONEUI_COLORS["text"])
+        self.response_cache_checkbox.pack(anchor="w", pady=(0, 5))
+
+        self.macro_mode_checkbox = ctk.CTkCheckBox(main_frame, text="Learn successful runs and replay them for repeated commands", variable=self.macro_mode, text_color=ONEUI_COLORS["text"])
+        self.macro_mode_checkbox.pack(anchor="w", pady=(0, 5))
+
+        self.hedge_mode_checkbox = ctk.CTkCheckBox(main_frame, text=f"Hedge slow requests with {HEDGE_SETTINGS['model']}", variable=self.hedge_mode, text_color=ONEUI_COLORS["text"])
+        self.hedge_mode_checkbox.pack(anchor="w", pady=(0, 5))
+
+        self.cascade_mode_checkbox = ctk.CTkCheckBox(main_frame, text="Try cheaper models first and escalate to the selected one", variable=self.cascade_mode, text_color=ONEUI_COLORS["text"])
+        self.cascade_mode_checkbox.pack(anchor="w", pady=(0, 5))
+
+        self.record_mode_checkbox = ctk.CTkCheckBox(main_frame, text="Record session for replay", variable=self.record_mode, text_color=ONEUI_COLORS["text"])
+        self.record_mode_checkbox.pack(anchor="w", pady=(0, 15))
+
+        ctk.CTkLabel(main_frame, text="Action speed:", font=("Roboto", 12, "bold"), text_color=ONEUI_COLORS["text"]).pack(anchor="w", pady=(0, 5))
+        self.timing_profile_combobox = ctk.CTkOptionMenu(main_frame, variable=self.timing_profile, values=list(TIMING_PROFILES))
+        self.timing_profile_combobox.pack(fill="x", pady=(0, 15))
+
         ctk.CTkLabel(main_frame, text="Enter command for AI:", font=("Roboto", 12, "bold"), text_color=ONEUI_COLORS["text"]).pack(anchor="w", pady=(0, 5))
         self.prompt_text = scrolledtext.ScrolledText(main_frame, height=8, wrap="word", font=("Roboto", 10),
                                                     bg=ONEUI_COLORS["widget_bg"], fg=ONEUI_COLORS["text"])
@@ -274,51 +349,41 @@ class AIportGUI:
         self.view_usage_button = ctk.CTkButton(button_frame, text="💰 View Usage", command=self.usage_monitor._show_usage_window_internal)
         self.view_usage_button.pack(side="left", expand=True, padx=5)
 
+        self.replay_button = ctk.CTkButton(button_frame, text="⏯️ Replay", command=self.start_replay)
+        self.replay_button.pack(side="left", expand=True, padx=5)
+
 
         ctk.CTkLabel(main_frame, text="AI activity log:", font=("Roboto", 12, "bold"), text_color=ONEUI_COLORS["text"]).pack(anchor="w", pady=(0, 5))
         self.log_area = scrolledtext.ScrolledText(main_frame, height=15, wrap="word", state="disabled", font=("TkFixedFont", 10),
                                                 bg=ONEUI_COLORS["widget_bg"], fg=ONEUI_COLORS["text"])
         self.log_area.pack(fill="both", expand=True)
+        self.log_sink = LogSink(self.root, self.log_area, **LOG_SETTINGS)
+
+        # The agent itself; it reports back through _on_engine_event from its own threads
+        self.engine = AgentEngine(self.usage_monitor, on_event=self._on_engine_event)
+        if self.engine.cursor_image is None:
+            messagebox.showwarning("Warning", "File 'cursor.png' not found. Screenshots will be taken without a cursor.")
 
         self._on_api_change("Ollama")
     
-    # New method to log messages with smooth scrolling
     def _log_with_animation(self, message):
-        self.log_area.configure(state="normal")
-        self.log_area.insert("end", message + "\n")
-        self.log_area.configure(state="disabled")
-        self._smooth_scroll()
-
-    # Smooth scroll to the end of the log
-    def _smooth_scroll(self):
-        current_y = float(self.log_area.yview()[0])
-        end_y = float(self.log_area.yview()[1])
-        
-        if end_y < 1.0:
-            scroll_by = 0.05
-            new_y = current_y + scroll_by
-            if new_y > 1.0:
-                new_y = 1.0
-            
-            self.log_area.yview_moveto(new_y)
-            self.root.after(10, self._smooth_scroll)
+        # Safe to call from any thread; the log view picks the line up on its next frame
+        self.log_sink.write(message)
+
+    def _on_engine_event(self, event):
+        # Called from the engine's threads; anything touching widgets goes through the Tk main loop
+        if event["event"] == "log":
+            self._log_with_animation(event["message"])
+        elif event["event"] == "error":
+            self.root.after(0, lambda: messagebox.showerror("Error", event["message"]))
+        elif event["event"] == "finished":
+            self.root.after(0, self._reset_controls)
 
     def _on_api_change(self, choice):
-        if choice == "Ollama":
-            self.model_combobox.configure(values=["llama3", "phi3"])
-            self.model_combobox.set("llama3")
-        elif choice == "OpenRouter":
-            self.model_combobox.configure(values=["openrouter/cinematika-7b", "google/gemini-flash-1.5-preview", "mistralai/mixtral-8x7b-instruct"])
-            self.model_combobox.set("openrouter/cinematika-7b")
-        elif choice == "Gemini":
-            self.model_combobox.configure(values=["gemini-2.5-flash", "gemini-2.0-flash", "gemini-1.5-flash", "gemini-1.5-pro", "gemini-1.0-pro"])
-            self.model_combobox.set("gemini-2.5-flash")
-        elif choice == "OpenAI":
-            self.model_combobox.configure(values=["gpt-4o", "gpt-4o-mini", "gpt-4-turbo"])
-            self.model_combobox.set("gpt-4o")
-        elif choice == "Claude":
-            self.model_combobox.configure(values=["claude-3-5-sonnet-20240620", "claude-3-opus-20240229", "claude-3-sonnet-20240229", "claude-3-haiku-20240307"])
-            self.model_combobox.set("claude-3-5-sonnet-20240620")
+        models = PROVIDER_MODELS.get(choice)
+        if models:
+            self.model_combobox.configure(values=models)
+            self.model_combobox.set(models[0])
 
     def start_agent(self):
         if not self.api_key.get() and self.api_provider.get() != "Ollama":
@@ -327,246 +392,67 @@ class AIportGUI:
         if not self.prompt_text.get("1.0", "end").strip():
             messagebox.showerror("Error", "Please enter a command for AI!")
             return
+        self._launch_agent()
+
+    def start_replay(self):
+        # Runs a recorded session through the loop: recorded frames in, recorded responses back,
+        # actions dropped. Nothing touches the desktop or the network.
+        path = filedialog.askopenfilename(initialdir=RECORDING_SETTINGS["dir"], filetypes=[("AIport sessions", "*.aiport"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            self.engine.replay = ReplaySession(path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            messagebox.showerror("Error", f"Could not open the recorded session.\nError: {e}")
+            return
+        self._launch_agent()
+
+    def _launch_agent(self):
+        # The engine reads its settings once when the run starts
+        engine = self.engine
+        engine.provider = self.api_provider.get()
+        engine.model = self.model.get()
+        engine.api_key = self.api_key.get()
+        engine.prompt = self.prompt_text.get("1.0", "end")
+        engine.diff_mode = self.diff_mode.get()
+        engine.stream_mode = self.stream_mode.get()
+        engine.settle_mode = self.settle_mode.get()
+        engine.timing_profile = self.timing_profile.get()
+        engine.record_mode = self.record_mode.get()
+        engine.response_cache_mode = self.response_cache_mode.get()
+        engine.macro_mode = self.macro_mode.get()
+        engine.hedge_mode = self.hedge_mode.get()
+        engine.cascade_mode = self.cascade_mode.get()
 
-        self.stop_flag = False
         self.start_button.configure(state="disabled")
+        self.replay_button.configure(state="disabled")
         self.stop_button.configure(state="normal")
-        self.log_area.configure(state="normal")
-        self.log_area.delete("1.0", "end")
-        self.log_area.configure(state="disabled")
+        self.log_sink.clear()
 
-        self.agent_thread = threading.Thread(target=self._run_agent_loop, daemon=True)
+        self.agent_thread = threading.Thread(target=engine.run, daemon=True)
         self.agent_thread.start()
 
     def stop_agent(self):
-        self.stop_flag = True
-        self.usage_monitor.stop_tracking()
+        self.engine.stop()
         self._log_with_animation("⏹️ Sending stop signal to AI...")
+        self._reset_controls()
+
+    def _reset_controls(self):
         self.start_button.configure(state="normal")
+        self.replay_button.configure(state="normal")
         self.stop_button.configure(state="disabled")
     
-    def _encode_image(self, filename):
-        with open(filename, "rb") as f:
-            return base64.b64encode(f.read()).decode("utf-8")
-
-    def _fetch_tutorial(self):
-        self._log_with_animation("🔗 Loading tutorial from GitHub URL...")
-        url = "https://raw.githubusercontent.com/truonghoangminhduc123-create/Training-data/refs/heads/main/Trainingdata.txt"
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            self.tutorial_content = response.text
-            self._log_with_animation("✅ Tutorial loaded successfully!")
-        except requests.exceptions.RequestException as e:
-            self._log_with_animation(f"❌ Error loading tutorial: {e}")
-            messagebox.showerror("Error", f"Failed to load tutorial from URL.\nError: {e}")
-            self.stop_agent()
-
-    def _send_to_ollama(self, img_b64, user_prompt):
-        model = self.model.get()
-        url = "http://localhost:11434/api/generate"
-        headers = {"Content-Type": "application/json"}
-        
-        payload = {
-            "model": model,
-            "prompt": f"{self.tutorial_content}\n\n{user_prompt}",
-            "stream": False,
-            "images": [img_b64],
-            "options": {
-                "num_ctx": 4096
-            }
-        }
-        
-        res = requests.post(url, headers=headers, data=json.dumps(payload))
-        res.raise_for_status()
-        response_data = res.json()
-        
-        # Estimate token usage
-        # This is a rough estimate, a real tokenizer would be more accurate
-        tokens_in = len((self.tutorial_content + user_prompt).split()) + 500  # Estimate image tokens
-        tokens_out = len(response_data.get("response", "").split())
-        self.usage_monitor.update_tokens(tokens_in, tokens_out)
-        
-        return response_data.get("response", "")
-
-    def _send_to_gemini(self, img_b64, user_prompt):
-        api_key = self.api_key.get()
-        model = self.model.get()
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
-        headers = {"Content-Type": "application/json"}
-        
-        payload = {"contents": [{"parts": [{"text": self.tutorial_content}, {"inline_data": {"mime_type": "image/png", "data": img_b64}}, {"text": user_prompt}]}]}
-        res = requests.post(url, headers=headers, data=json.dumps(payload))
-        res.raise_for_status()
-        
-        response_text = res.json()["candidates"][0]["content"]["parts"][0]["text"]
-        
-        # Estimate token usage
-        tokens_in = len((self.tutorial_content + user_prompt).split()) + 500
-        tokens_out = len(response_text.split())
-        self.usage_monitor.update_tokens(tokens_in, tokens_out)
-
-        return response_text
-
-    def _send_to_openrouter(self, img_b64, user_prompt):
-        api_key = self.api_key.get()
-        model = self.model.get()
-        url = "https://openrouter.ai/api/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": model,
-            "messages": [
-                {"role": "user", "content": [
-                    {"type": "text", "text": self.tutorial_content + "\n\n" + user_prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
-                ]}
-            ]
-        }
-        res = requests.post(url, headers=headers, data=json.dumps(payload))
-        res.raise_for_status()
-        response_json = res.json()
-
-        # Update token usage from API response (if available) or estimate
-        tokens_in = response_json["usage"]["prompt_tokens"] if "usage" in response_json else len((self.tutorial_content + user_prompt).split()) + 500
-        tokens_out = response_json["usage"]["completion_tokens"] if "usage" in response_json else len(response_json["choices"][0]["message"]["content"].split())
-        self.usage_monitor.update_tokens(tokens_in, tokens_out)
-
-        return response_json["choices"][0]["message"]["content"]
-    
-    def _send_to_openai(self, img_b64, user_prompt):
-        api_key = self.api_key.get()
-        model = self.model.get()
-        url = "https://api.openai.com/v1/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        payload = {
-            "model": model,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": self.tutorial_content + "\n\n" + user_prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
-                    ]
-                }
-            ],
-            "max_tokens": 4096
-        }
-        res = requests.post(url, headers=headers, json=payload)
-        res.raise_for_status()
-        response_json = res.json()
-        
-        # Update token usage from API response
-        tokens_in = response_json["usage"]["prompt_tokens"]
-        tokens_out = response_json["usage"]["completion_tokens"]
-        self.usage_monitor.update_tokens(tokens_in, tokens_out)
-        
-        return response_json["choices"][0]["message"]["content"]
-
-    def _send_to_claude(self, img_b64, user_prompt):
-        api_key = self.api_key.get()
-        model = self.model.get()
-        url = "https://api.anthropic.com/v1/messages"
-        headers = {
-            "x-api-key": api_key,
-            "anthropic-version": "2023-06-01",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": model,
-            "max_tokens": 4096,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": img_b64}},
-                        {"type": "text", "text": self.tutorial_content + "\n\n" + user_prompt}
-                    ]
-                }
-            ]
-        }
-        res = requests.post(url, headers=headers, json=payload)
-        res.raise_for_status()
-        response_json = res.json()
-
-        # Update token usage from API response
-        tokens_in = response_json["usage"]["input_tokens"]
-        tokens_out = response_json["usage"]["output_tokens"]
-        self.usage_monitor.update_tokens(tokens_in, tokens_out)
-        
-        return response_json["content"][0]["text"]
-
-    def _execute_actions(self, actions):
-        for action in actions:
-            t = action.get("type")
-            self._log_with_animation(f"   - Executing: {t} with {action}")
-            if t == "move":
-                pyautogui.moveTo(action["x"], action["y"], duration=0.5)
-            elif t == "click":
-                pyautogui.click(button=action.get("button", "left"), clicks=action.get("count", 1))
-            elif t == "click_down":
-                pyautogui.mouseDown(button=action.get("button", "left"))
-            elif t == "click_up":
-                pyautogui.mouseUp(button=action.get("button", "left"))
-            elif t == "scroll":
-                pyautogui.scroll(action.get("dy", 0))
-            elif t == "type":
-                pyautogui.typewrite(action["text"], interval=0.05)
-            elif t == "hotkey":
-                pyautogui.hotkey(*action["keys"])
-            elif t == "speak":
-                text_to_speak = action.get("text", "")
-                if text_to_speak:
-                    self._log_with_animation(f"   - Speaking: {text_to_speak}")
-                    try:
-                        try:
-                            detected_lang = langdetect.detect(text_to_speak)
-                            self._log_with_animation(f"     -> Detected language: {detected_lang}")
-                        except langdetect.lang_detect_exception.LangDetectException:
-                            detected_lang = 'en'
-                            self._log_with_animation("     -> Could not detect language. Defaulting to 'en'.")
-                        
-                        tts = gTTS(text=text_to_speak, lang=detected_lang)
-                        temp_file_path = os.path.join(tempfile.gettempdir(), f"speech_{int(time.time())}.mp3")
-                        tts.save(temp_file_path)
-                        
-                        self._log_with_animation(f"     -> Playing audio from Google TTS...")
-                        playsound(temp_file_path)
-                        
-                        os.remove(temp_file_path)
-                    except Exception as e:
-                        self._log_with_animation(f"❌ Error during text-to-speech with gTTS: {e}")
-            elif t == "multi_click":
-                for _ in range(action.get("count", 2)):
-                    pyautogui.click(action["x"], action["y"])
-                    time.sleep(0.05)
-            elif t == "key_down_for_seconds":
-                key = action.get("key")
-                duration = action.get("duration", 1.0)
-                if key:
-                    pyautogui.keyDown(key)
-                    self._log_with_animation(f"   - Holding key: {key} for {duration} seconds")
-                    time.sleep(duration)
-                    pyautogui.keyUp(key)
-            time.sleep(0.5)
 
     def view_last_screenshot(self):
-        if not self.last_screenshot_path or not os.path.exists(self.last_screenshot_path):
+        if self.engine.last_screenshot is None:
             messagebox.showinfo("Notice", "No screenshots have been taken yet.")
             return
 
         view_window = ctk.CTkToplevel(self.root)
         view_window.title("Screenshot")
         
-        img = Image.open(self.last_screenshot_path)
+        # The frame only lives in memory; work on a copy so the thumbnail doesn't touch it
+        img = self.engine.last_screenshot.copy()
         max_size = (800, 600)
         img.thumbnail(max_size)
         
@@ -575,113 +461,29 @@ class AIportGUI:
         label = ctk.CTkLabel(view_window, image=tk_img, text="")
         label.pack()
 
+        save_button = ctk.CTkButton(view_window, text="Save", command=self.save_last_screenshot)
+        save_button.pack(pady=(10, 0))
+
         close_button = ctk.CTkButton(view_window, text="Close", command=view_window.destroy)
         close_button.pack(pady=10)
-
-    def _run_agent_loop(self):
-        self._log_with_animation("▶️ AI agent starting...")
-        user_prompt = self.prompt_text.get("1.0", "end").strip()
-        
-        self._fetch_tutorial()
-        if not self.tutorial_content:
-            self._log_with_animation("❌ Failed to load tutorial. Stopping agent.")
-            self.stop_agent()
+    def save_last_screenshot(self):
+        # Frames are only written to disk when the user asks to archive one
+        if self.engine.last_screenshot is None:
+            messagebox.showinfo("Notice", "No screenshots have been taken yet.")
             return
-            
-        self.usage_monitor.start_tracking(self.model.get())
-
-        temp_dir = tempfile.gettempdir()
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
-
-        while not self.stop_flag:
-            self._cleanup_temp_files()
-            try:
-                self.last_screenshot_path = os.path.join(temp_dir, f"screenshot_{int(time.time())}.png")
-
-                self._log_with_animation(f"\n[1] Taking new screenshot: {self.last_screenshot_path}")
-                
-                screenshot = pyautogui.screenshot()
-                mouse_x, mouse_y = pyautogui.position()
-                self._log_with_animation(f"   -> Mouse position: ({mouse_x}, {mouse_y})")
-
-                if self.cursor_image:
-                    cursor_copy = self.cursor_image.copy()
-                    screen_width, screen_height = pyautogui.size()
-                    ratio = min(screen_width / 1920, screen_height / 1080)
-                    new_size = (int(cursor_copy.width * ratio), int(cursor_copy.height * ratio))
-                    cursor_copy = cursor_copy.resize(new_size, Image.Resampling.LANCZOS)
-                    
-                    paste_x = mouse_x - int(cursor_copy.width / 2)
-                    paste_y = mouse_y - int(cursor_copy.height / 2)
-                    
-                    screenshot.paste(cursor_copy, (paste_x, paste_y), cursor_copy)
-
-                screenshot.save(self.last_screenshot_path)
-                
-                img_b64 = self._encode_image(self.last_screenshot_path)
-
-                self._log_with_animation("[2] Sending image and command to AI...")
-
-                api_provider = self.api_provider.get()
-                if api_provider == "Ollama":
-                    response_text = self._send_to_ollama(img_b64, user_prompt)
-                elif api_provider == "Gemini":
-                    response_text = self._send_to_gemini(img_b64, user_prompt)
-                elif api_provider == "OpenRouter":
-                    response_text = self._send_to_openrouter(img_b64, user_prompt)
-                elif api_provider == "OpenAI":
-                    response_text = self._send_to_openai(img_b64, user_prompt)
-                elif api_provider == "Claude":
-                    response_text = self._send_to_claude(img_b64, user_prompt)
-                else:
-                    self._log_with_animation("❌ Error: Unsupported API Provider.")
-                    break
-                
-                self._log_with_animation("[3] AI response:\n" + response_text)
-
-                try:
-                    clean_ai_text = response_text.strip().replace("```json", "").replace("```", "")
-                    actions = json.loads(clean_ai_text)
-                    
-                    if not actions:
-                        self._log_with_animation("✅ AI thinks the task is complete. Stopping.")
-                        break
-
-                    self._log_with_animation("[4] Executing actions:")
-                    self._execute_actions(actions)
-                except Exception as e:
-                    self._log_with_animation(f"❌ Error parsing JSON or executing: {e}")
-
-                time.sleep(2)
-
-            except Exception as e:
-                self._log_with_animation(f"❌ Error in main loop: {e}")
-                if "API_KEY_INVALID" in str(e) or "AuthenticationError" in str(e):
-                    self._log_with_animation("ERROR: Invalid API Key. Please check again.")
-                elif "404" in str(e):
-                    self._log_with_animation("ERROR: API path not found. You might have selected a model that doesn't support screenshots.")
-                    self._log_with_animation("Please try again with a different model, for example 'gpt-4o'.")
-                break
-                time.sleep(2)
-        
-        if self.stop_flag:
-             self._log_with_animation("⏹️ AI stopped by user.")
-        self.stop_agent()
-        self._cleanup_temp_files()
-
-    def _cleanup_temp_files(self):
-        temp_dir = tempfile.gettempdir()
-        for filename in os.listdir(temp_dir):
-            if filename.startswith("screenshot_") and filename.endswith(".png"):
-                file_path = os.path.join(temp_dir, filename)
-                try:
-                    os.remove(file_path)
-                except OSError as e:
-                    self._log_with_animation(f"Error deleting temporary file {file_path}: {e}")
+
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".png",
+            initialfile=f"screenshot_{int(time.time())}.png",
+            filetypes=[("PNG image", "*.png")]
+        )
+        if file_path:
+            self.engine.last_screenshot.save(file_path)
 
 # ================== RUN ==================
 if __name__ == "__main__":
     root = ctk.CTk()
     app = AIportGUI(root)
     root.mainloop()
+    app.usage_monitor.ledger.close()
+    app.log_sink.close()
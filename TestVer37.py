@@ -5,6 +5,10 @@ import base64
 import requests
 import pyautogui
 import threading
+import queue
+import collections
+import logging
+import logging.handlers
 from tkinter import messagebox, scrolledtext
 import tempfile
 from PIL import Image, ImageTk
@@ -21,9 +25,80 @@ ONEUI_COLORS = {
     "widget_bg": "#2a2a2a"
 }
 
+# Log lines are shown in batches "frame_rate" times per second and the log view keeps only the
+# last "max_lines" lines; the full log is written to a rotating file.
+LOG_SETTINGS = {
+    "max_lines": 2000,
+    "frame_rate": 20,
+    "file_path": os.path.join(os.path.expanduser("~"), ".aiport", "logs", "testver37.log"),
+    "max_file_bytes": 5 * 1024 * 1024,
+    "backup_count": 3
+}
+
 ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("blue")
 
+class LogSink:
+    """Collects log lines from any thread and shows them in a Tk text widget in batches."""
+
+    def __init__(self, root, widget, max_lines=2000, frame_rate=20, file_path=None, max_file_bytes=5 * 1024 * 1024, backup_count=3):
+        self.root = root
+        self.widget = widget
+        self.max_lines = max_lines
+        self.frame_interval = max(1, 1000 // frame_rate)
+        # deque.append/popleft are atomic, so writers never block on the UI
+        self.pending = collections.deque()
+        self.listener = None
+        if file_path:
+            # The full log goes to a rotating file from a background thread
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(file_path, maxBytes=max_file_bytes, backupCount=backup_count, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.file_queue = queue.SimpleQueue()
+            self.file_logger = logging.getLogger(f"aiport.log.{id(self)}")
+            self.file_logger.propagate = False
+            self.file_logger.setLevel(logging.INFO)
+            self.file_logger.addHandler(logging.handlers.QueueHandler(self.file_queue))
+            self.listener = logging.handlers.QueueListener(self.file_queue, handler)
+            self.listener.start()
+        self.root.after(self.frame_interval, self._drain)
+
+    def write(self, message):
+        self.pending.append(message)
+        if self.listener is not None:
+            self.file_logger.info(message)
+
+    def clear(self):
+        # Main thread only
+        self.pending.clear()
+        self.widget.configure(state="normal")
+        self.widget.delete("1.0", "end")
+        self.widget.configure(state="disabled")
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def _drain(self):
+        # Runs on the Tk main loop once per frame and inserts everything queued since the last frame
+        lines = []
+        try:
+            while True:
+                lines.append(self.pending.popleft())
+        except IndexError:
+            pass
+        if lines:
+            self.widget.configure(state="normal")
+            self.widget.insert("end", "\n".join(lines) + "\n")
+            # Keep only the newest max_lines lines
+            line_count = int(self.widget.index("end-1c").split(".")[0]) - 1
+            if line_count > self.max_lines:
+                self.widget.delete("1.0", f"{line_count - self.max_lines + 1}.0")
+            self.widget.configure(state="disabled")
+            self.widget.see("end")
+        self.root.after(self.frame_interval, self._drain)
+
 class AIportGUI:
     def __init__(self, root):
         self.root = root
@@ -79,6 +154,7 @@ class AIportGUI:
         self.log_area = scrolledtext.ScrolledText(main_frame, height=15, wrap="word", state="disabled", font=("Roboto Mono", 10),
                                                 bg=ONEUI_COLORS["widget_bg"], fg=ONEUI_COLORS["text"])
         self.log_area.pack(fill="both", expand=True)
+        self.log_sink = LogSink(self.root, self.log_area, **LOG_SETTINGS)
 
         self._on_api_change("Ollama")
 
@@ -100,28 +176,8 @@ class AIportGUI:
             self.model_combobox.set("claude-3-5-sonnet-20240620")
     
     def _log_with_animation(self, message):
-        self.log_area.configure(state="normal")
-        self._animate_text(message)
-        self.log_area.configure(state="disabled")
-
-    def _animate_text(self, text, index=0):
-        if index < len(text):
-            char = text[index]
-            self.log_area.insert("end", char)
-            self._smooth_scroll_down()
-            self.root.after(1, self._animate_text, text, index + 1)
-        elif index == len(text):
-            self.log_area.insert("end", "\n")
-            self._smooth_scroll_down()
-
-    def _smooth_scroll_down(self):
-        end_position = self.log_area.yview()[1]
-        if end_position < 1.0:
-            self.log_area.yview_scroll(1, "units")
-            self.root.after(5, self._smooth_scroll_down)
-        else:
-            self.log_area.yview_scroll(10, "units") # Hard jump to ensure it is at the very end
-            self.log_area.update_idletasks()
+        # Safe to call from any thread; the log view picks the line up on its next frame
+        self.log_sink.write(message)
 
     def start_agent(self):
         if not self.api_key.get() and self.api_provider.get() != "Ollama":
@@ -134,9 +190,7 @@ class AIportGUI:
         self.stop_flag = False
         self.start_button.configure(state="disabled")
         self.stop_button.configure(state="normal")
-        self.log_area.configure(state="normal")
-        self.log_area.delete("1.0", "end")
-        self.log_area.configure(state="disabled")
+        self.log_sink.clear()
 
         self.agent_thread = threading.Thread(target=self._run_agent_loop, daemon=True)
         self.agent_thread.start()
@@ -410,4 +464,5 @@ if __name__ == "__main__":
     root = ctk.CTk()
     app = AIportGUI(root)
     root.mainloop()
+    app.log_sink.close()
 
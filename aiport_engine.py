@@ -0,0 +1,3221 @@
+# Headless core of AIport: screen capture, model inference and action execution, without any
+# UI. AIportv3.7.py drives it from the window; the command line below drives it from scripts
+# and services and prints one JSON object per event on stdout.
+#
+#   python aiport_engine.py --provider OpenAI --model gpt-4o --prompt "Open google.com"
+#   AIPORT_PROVIDER=Claude AIPORT_API_KEY=... python aiport_engine.py --prompt - --stream < task.txt
+#   python aiport_engine.py --replay ~/.aiport/sessions/session-20250101-120000.aiport --quiet
+
+import os
+import sys
+import time
+import math
+import json
+import io
+import re
+import base64
+import hashlib
+import gzip
+import argparse
+import requests
+import urllib.parse
+from requests.adapters import HTTPAdapter
+import threading
+import queue
+import datetime
+import email.utils
+import random
+import collections
+import contextlib
+import sqlite3
+import zipfile
+import numpy as np
+import tempfile
+from PIL import Image, ImageChops
+from gtts import gTTS
+from playsound import playsound
+try:
+    import pyperclip
+except ImportError:
+    pyperclip = None
+import langdetect
+
+# Models offered per provider; the first one is the default
+PROVIDER_MODELS = {
+    "Ollama": ["llama3", "phi3"],
+    "Gemini": ["gemini-2.5-flash", "gemini-2.0-flash", "gemini-1.5-flash", "gemini-1.5-pro", "gemini-1.0-pro"],
+    "OpenRouter": ["openrouter/cinematika-7b", "google/gemini-flash-1.5-preview", "mistralai/mixtral-8x7b-instruct"],
+    "OpenAI": ["gpt-4o", "gpt-4o-mini", "gpt-4-turbo"],
+    "Claude": ["claude-3-5-sonnet-20240620", "claude-3-opus-20240229", "claude-3-sonnet-20240229", "claude-3-haiku-20240307"]
+}
+
+# Placeholders spliced out of serialized request bodies and replaced by the frame bytes
+# (formatted with the index of the image in the request) and by the per-step prompt
+FRAME_PLACEHOLDER = "__AIPORT_FRAME_B64_{}__"
+PROMPT_PLACEHOLDER = "__AIPORT_PROMPT__"
+PLACEHOLDER_PATTERN = re.compile(rb"__AIPORT_(?:FRAME_B64_(\d+)|PROMPT)__")
+
+# How screenshots are encoded for each provider. Frames are downscaled so neither edge exceeds
+# what the provider keeps after its own resizing, and no larger than "max_pixels" in total where the
+# provider also limits the area, then encoded with the given codec and quality.
+# "grayscale" drops color, "palette" (PNG only) quantizes to that many colors.
+# Entries under "models" override the provider defaults for a specific model.
+ENCODING_PROFILES = {
+    "Ollama": {"max_edge": 1344, "format": "JPEG", "quality": 80},
+    "Gemini": {"max_edge": 3072, "format": "WEBP", "quality": 80,
+               "models": {"gemini-1.0-pro": {"max_edge": 1536}}},
+    "OpenRouter": {"max_edge": 1568, "format": "JPEG", "quality": 80},
+    # High detail images are fit into 2048x2048, then the short side is cut to 768
+    "OpenAI": {"max_edge": 2048, "max_short_edge": 768, "format": "WEBP", "quality": 80,
+               "models": {"gpt-4o-mini": {"quality": 70}}},
+    # Images over ~1.15 megapixels are resized by the API before the model sees them,
+    # so 16:9 frames end up around 1430x804
+    "Claude": {"max_edge": 1568, "max_pixels": 1_150_000, "format": "WEBP", "quality": 80,
+               "models": {"claude-3-haiku-20240307": {"max_edge": 1092}}},
+    "default": {"max_edge": 1568, "format": "PNG"}
+}
+
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+# Timing of the pipelined agent loop. After a step's actions finish, the screen gets
+# "settle_delay" seconds before the next frame is taken; meanwhile frames are captured and
+# encoded speculatively every "speculate_interval" seconds.
+PIPELINE_SETTINGS = {
+    "settle_delay": 2.0,
+    "speculate_interval": 0.25,
+    "action_queue_size": 32
+}
+
+# How fast actions are executed, picked per run. "move_duration" is the mouse glide time,
+# "type_interval" the delay between typed keys, "click_gap" the gap between the clicks of a
+# multi_click, "action_pause" the wait after each action (when not waiting for the screen to
+# settle) and "pyautogui_pause" pyautogui's own pause after every call. Texts of at least
+# "paste_min_chars" characters are pasted through the clipboard instead of typed.
+TIMING_PROFILES = {
+    "human": {"move_duration": 0.5, "type_interval": 0.05, "click_gap": 0.05, "action_pause": 0.5, "pyautogui_pause": 0.1, "paste_min_chars": 200},
+    "fast": {"move_duration": 0.1, "type_interval": 0.01, "click_gap": 0.02, "action_pause": 0.15, "pyautogui_pause": 0.02, "paste_min_chars": 40},
+    "instant": {"move_duration": 0.0, "type_interval": 0.0, "click_gap": 0.0, "action_pause": 0.0, "pyautogui_pause": 0.0, "paste_min_chars": 1}
+}
+
+# Marks the end of one step's actions in the execution queue
+STEP_END = object()
+
+# Gate in front of every model call. A frame counts as unchanged when its dHash is fewer than
+# "threshold" bits from the last submitted frame's and, on a grayscale copy downscaled to about
+# "sample_edge" pixels, fewer than "min_changed_pixels" pixels differ by more than "tolerance"
+# (the hash alone misses typed text or a focus ring). An unchanged screen is re-polled every
+# "poll_interval" seconds and sent anyway after "max_wait" seconds.
+FRAME_GATE_SETTINGS = {
+    "threshold": 2,
+    "hash_size": 16,
+    "sample_edge": 480,
+    "tolerance": 24,
+    "min_changed_pixels": 12,
+    "poll_interval": 0.25,
+    "max_wait": 2.0
+}
+
+# Local data (tutorial cache etc.) lives here
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".aiport")
+
+# Where the tutorial comes from. The cached copy is used right away and revalidated in the
+# background once it's older than "ttl" seconds; downloads give up after "timeout" seconds.
+# If "local_file" exists it is used instead and the network is never touched, e.g. on
+# air-gapped machines.
+TUTORIAL_SETTINGS = {
+    "url": "https://raw.githubusercontent.com/truonghoangminhduc123-create/Training-data/refs/heads/main/Trainingdata.txt",
+    "ttl": 24 * 3600,
+    "timeout": 30.0,
+    "local_file": os.environ.get("AIPORT_TUTORIAL_FILE", "Trainingdata.txt")
+}
+
+# Spending caps checked before every request. Caps set to None are not enforced; all of them are
+# off by default (set e.g. "task_cost": 0.50 to opt in). Once a request would bring usage past
+# "degrade_at" of a cap the agent first sends smaller images, then also a shortened tutorial; a
+# request that would exceed a cap stops the agent. Costs use UsageTracker.PRICES.
+BUDGET_SETTINGS = {
+    "task_tokens": None,
+    "task_cost": None,
+    "day_tokens": None,
+    "day_cost": None,
+    "degrade_at": 0.8,
+    "expected_tokens_out": 300,
+    "degraded_image_scale": 0.5,
+    "degraded_tutorial_chars": 4000
+}
+
+# With "Record session" checked, every step (frame, prompt, raw response, parsed actions, timings)
+# is written to one archive in "dir". Frames are stored as a full keyframe every "keyframe_interval"
+# steps and otherwise as the "tile_size" tiles that changed since the previous frame; a frame where
+# more than "max_delta_ratio" of the tiles changed becomes a keyframe. "replay_latency" makes a
+# replay wait as long as the recorded model calls took instead of answering at once.
+RECORDING_SETTINGS = {
+    "dir": os.path.join(CACHE_DIR, "sessions"),
+    "tile_size": 32,
+    "keyframe_interval": 30,
+    "max_delta_ratio": 0.5,
+    "replay_latency": False
+}
+
+# With "Reuse responses" checked, replies are cached on disk by the perceptual hash of the frame,
+# a digest of its grayscale pixels downscaled to "sample_edge" on the long side (16 gray levels,
+# so a typed character or a toggled checkbox changes the key), the prompt, the tutorial version
+# and the model, and a screen seen before is answered from the cache without a model call.
+# Entries expire after "ttl" seconds; the least recently used ones are evicted past "max_bytes".
+# "crop" = (left, top, right, bottom) as fractions of the screen limits the key to that part,
+# e.g. (0, 0, 1, 0.95) leaves out a taskbar clock.
+RESPONSE_CACHE_SETTINGS = {
+    "dir": os.path.join(CACHE_DIR, "responses"),
+    "max_bytes": 20 * 1024 * 1024,
+    "ttl": 7 * 24 * 3600,
+    "hash_size": 16,
+    "sample_edge": 240,
+    "crop": None
+}
+
+# Runs that end with the task complete are saved in "dir" as learned macros: per step, the hash
+# and a grayscale thumbnail of the screen and the actions taken. When the same command is given again
+# (and learning is switched on) the macro is replayed without model calls as long as each screen passes
+# the frame gate's unchanged check against the recorded one, so a dialog or a changed field breaks the
+# match; at the first screen that differs the model takes over.
+MACRO_SETTINGS = {
+    "dir": os.path.join(CACHE_DIR, "macros")
+}
+
+# With "Hedge slow requests" checked, a request the primary model hasn't answered within its
+# observed "percentile" latency (or "default_delay" seconds until "min_samples" replies were seen)
+# is also sent to this secondary provider/model. The first parseable action list wins and the other
+# request is cancelled. The secondary's key is read from AIPORT_HEDGE_API_KEY.
+HEDGE_SETTINGS = {
+    "provider": "Gemini",
+    "model": "gemini-2.5-flash",
+    "api_key": os.environ.get("AIPORT_HEDGE_API_KEY", ""),
+    "percentile": 0.9,
+    "min_samples": 5,
+    "default_delay": 8.0,
+    "min_delay": 0.5
+}
+
+# With "Try cheaper models first" checked, each step goes to these tiers in order before the model
+# selected above, which is always the last tier. A step moves up a tier when the reply isn't a JSON
+# action list, points outside the image, says the task is done (only the selected model can end
+# it), or the request fails (that tier is then skipped for the rest of the run); when a step's actions left the screen unchanged, the next step starts one tier
+# higher. Tiers without a key are skipped, except Ollama; a tier of the selected provider without
+# its own key uses the key entered above.
+CASCADE_SETTINGS = {
+    "tiers": [
+        {"provider": "Ollama", "model": "llama3", "api_key": ""},
+        {"provider": "Gemini", "model": "gemini-2.5-flash", "api_key": os.environ.get("AIPORT_GEMINI_API_KEY", "")}
+    ]
+}
+
+# Every model request is appended to this SQLite ledger
+USAGE_LEDGER_PATH = os.path.join(CACHE_DIR, "usage.db")
+
+# Daily totals written by versions before the ledger; imported into it once if present
+LEGACY_USAGE_PATH = "money_usage.json"
+
+# Per-stage latencies keep the last "window" samples per provider/model/stage. While the agent
+# runs they are exported every "export_interval" seconds to "export_dir" as metrics.prom
+# (Prometheus text format, e.g. for the node_exporter textfile collector) and metrics.json.
+METRICS_SETTINGS = {
+    "window": 1000,
+    "export_interval": 15,
+    "export_dir": os.path.join(CACHE_DIR, "metrics")
+}
+
+# Synthesized speech clips are cached on disk by (text, language); the least recently played
+# clips are evicted once the cache grows past "max_cache_bytes".
+SPEECH_SETTINGS = {
+    "cache_dir": os.path.join(CACHE_DIR, "speech"),
+    "max_cache_bytes": 50 * 1024 * 1024,
+    "default_lang": "en"
+}
+
+# Connection pooling and timeouts for provider calls. "compress" lists the providers whose
+# request bodies are gzip-compressed; only add providers whose endpoint accepts Content-Encoding: gzip.
+# "base_urls" sends a provider's requests to another scheme://host (a proxy, or the local
+# stand-in server of benchmark.py) while keeping the path and query.
+HTTP_SETTINGS = {
+    "pool_size": 4,
+    "connect_timeout": 5.0,
+    "read_timeout": 120.0,
+    "compress": [],
+    "base_urls": {}
+}
+
+# Requests per provider/model are spread out by a token bucket refilled at the model's "rpm"
+# from UsageTracker.PRICES, allowing bursts of "burst" requests. Responses with a status in
+# "retry_statuses" are retried up to "max_retries" times, after the delay the provider asks for
+# or an exponential backoff with jitter.
+RATE_LIMIT_SETTINGS = {
+    "burst": 2,
+    "max_retries": 6,
+    "backoff_base": 2.0,
+    "backoff_max": 60.0,
+    "retry_statuses": (429, 503)
+}
+
+class UsageLedger:
+    """Append-only record of every model request in SQLite, written from a background thread."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY, started REAL, prompt TEXT
+        );
+        CREATE TABLE IF NOT EXISTS requests (
+            ts REAL, day TEXT, task_id TEXT, provider TEXT, model TEXT,
+            tokens_in INTEGER, tokens_out INTEGER, cached_tokens INTEGER, cache_write_tokens INTEGER,
+            latency REAL, cost REAL
+        );
+        CREATE INDEX IF NOT EXISTS requests_day ON requests (day);
+        CREATE INDEX IF NOT EXISTS requests_task ON requests (task_id);
+    """
+
+    # Task the imported money_usage.json history is filed under; its presence marks the import as done
+    LEGACY_TASK_ID = "imported-money_usage"
+
+    def __init__(self, path, log=None, legacy_path=None):
+        self.path = path
+        # Write errors go here; stdout is reserved for the CLI's event stream
+        self.log = log or (lambda message: sys.stderr.write(message + "\n"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets the usage window read while the writer appends
+        self.reader.execute("PRAGMA journal_mode=WAL")
+        self.reader.executescript(self.SCHEMA)
+        self.reader_lock = threading.Lock()
+        if legacy_path:
+            self._import_legacy(legacy_path)
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def start_task(self, task_id, prompt):
+        self.queue.put(("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?)", (task_id, time.time(), prompt)))
+
+    def record(self, task_id, provider, model, tokens_in, tokens_out, cached_tokens, cache_write_tokens, latency, cost):
+        now = time.time()
+        day = datetime.date.fromtimestamp(now).isoformat()
+        self.queue.put(("INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (now, day, task_id, provider, model, tokens_in, tokens_out, cached_tokens, cache_write_tokens, latency, cost)))
+
+    def close(self):
+        # Flushes pending rows
+        self.queue.put(None)
+        self.writer.join(timeout=5)
+
+    def _write_loop(self):
+        connection = sqlite3.connect(self.path)
+        while True:
+            batch = [self.queue.get()]
+            # Everything queued meanwhile goes into the same transaction
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                with connection:
+                    for item in batch:
+                        if item is not None:
+                            connection.execute(*item)
+            except sqlite3.Error as e:
+                self.log(f"Error writing usage ledger: {e}")
+            if None in batch:
+                connection.close()
+                return
+
+    def _import_legacy(self, path):
+        # money_usage.json kept one entry per day: the model and totals of that day's last run.
+        # Each day becomes "total_requests" rows that add up to its tokens and cost.
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or self._query("SELECT 1 FROM tasks WHERE task_id = ?", (self.LEGACY_TASK_ID,)):
+            return
+        rows = []
+        days = 0
+        for day, entry in data.items():
+            try:
+                ts = datetime.datetime.combine(datetime.date.fromisoformat(day), datetime.time(12)).timestamp()
+                count = max(1, int(entry.get("total_requests", 0)))
+                tokens_in, tokens_out = int(entry.get("tokens_in", 0)), int(entry.get("tokens_out", 0))
+                cost = float(entry.get("current_cost_usd", 0.0))
+            except (AttributeError, TypeError, ValueError):
+                continue
+            days += 1
+            for index in range(count):
+                rows.append((ts, day, self.LEGACY_TASK_ID, "", entry.get("model", ""),
+                             tokens_in // count + (index < tokens_in % count), tokens_out // count + (index < tokens_out % count),
+                             0, 0, 0.0, cost / count))
+        with self.reader_lock, self.reader:
+            self.reader.execute("INSERT INTO tasks VALUES (?, ?, ?)", (self.LEGACY_TASK_ID, min((row[0] for row in rows), default=time.time()), f"Imported from {path}"))
+            self.reader.executemany("INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.log(f"Imported {days} days of usage history from {path} into the usage ledger.")
+
+    def _query(self, sql, params=()):
+        with self.reader_lock:
+            return self.reader.execute(sql, params).fetchall()
+
+    def day_totals(self, day=None):
+        # (requests, tokens, cost) for one day, today by default
+        day = day or datetime.date.today().isoformat()
+        return self._query("SELECT COUNT(*), COALESCE(SUM(tokens_in + tokens_out), 0), COALESCE(SUM(cost), 0) FROM requests WHERE day = ?", (day,))[0]
+
+    def per_day(self, days=7):
+        return self._query("SELECT day, COUNT(*), SUM(tokens_in + tokens_out), SUM(cost) FROM requests GROUP BY day ORDER BY day DESC LIMIT ?", (days,))
+
+    def per_model(self, day=None):
+        day = day or datetime.date.today().isoformat()
+        return self._query("SELECT model, COUNT(*), SUM(tokens_in + tokens_out), SUM(cost), AVG(latency) FROM requests WHERE day = ? GROUP BY model ORDER BY SUM(cost) DESC", (day,))
+
+    def per_task(self, limit=5):
+        return self._query("""
+            SELECT tasks.prompt, COUNT(requests.ts), COALESCE(SUM(requests.tokens_in + requests.tokens_out), 0), COALESCE(SUM(requests.cost), 0)
+            FROM tasks LEFT JOIN requests ON requests.task_id = tasks.task_id
+            GROUP BY tasks.task_id ORDER BY tasks.started DESC LIMIT ?""", (limit,))
+
+class UsageTracker:
+    """Tracks and logs AI usage and costs of the current run."""
+    
+    def __init__(self):
+        self.start_time = None
+        self.total_tokens_in = 0
+        self.total_tokens_out = 0
+        self.total_requests = 0
+        self.skipped_requests = 0
+        self.total_cached_tokens = 0
+        self.total_cache_write_tokens = 0
+        self.cache_hits = 0
+        self.response_cache_hits = 0
+        self.response_cache_saved = 0.0
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        self.hedge_cost = 0.0
+        # Per-step routing decisions of the model cascade
+        self.routing = collections.deque(maxlen=500)
+        self.cascade_saved = 0.0
+        self.current_model = ""
+        self.is_running = False
+        # Hedged requests book their usage from their own threads
+        self.lock = threading.Lock()
+        # TokenBudget of the current run, shown in the usage window when set
+        self.budget = None
+        self.ledger = UsageLedger(USAGE_LEDGER_PATH, legacy_path=LEGACY_USAGE_PATH)
+        self.task_id = None
+        self.latency = LatencyStats(METRICS_SETTINGS["window"])
+
+        # Estimated prices per 1 million tokens (in USD) and RPM limits
+        # These are estimates and may be subject to change.
+        # "cached" / "cache_write" price input tokens read from / written to the prompt cache;
+        # models without them are billed at the normal input price.
+        self.PRICES = {
+            "gpt-4o": {"in": 5.0, "out": 15.0, "cached": 2.5, "rpm": 60},
+            "gemini-2.5-flash": {"in": 0.35, "out": 1.05, "cached": 0.0875, "rpm": 20},
+            "claude-3-5-sonnet-20240620": {"in": 3.0, "out": 15.0, "cached": 0.3, "cache_write": 3.75, "rpm": 40},
+            "llama3": {"in": 0, "out": 0, "rpm": 90},  # Free for local usage
+            "phi3": {"in": 0, "out": 0, "rpm": 90},    # Free for local usage
+            "default": {"in": 0, "out": 0, "rpm": 30}
+        }
+
+    def start_tracking(self, model, prompt=""):
+        with self.lock:
+            self._start_tracking(model, prompt)
+
+    def _start_tracking(self, model, prompt):
+        self.start_time = time.time()
+        self.task_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        self.ledger.start_task(self.task_id, prompt)
+        self.current_model = model
+        self.total_tokens_in = 0
+        self.total_tokens_out = 0
+        self.total_requests = 0
+        self.skipped_requests = 0
+        self.total_cached_tokens = 0
+        self.total_cache_write_tokens = 0
+        self.cache_hits = 0
+        self.response_cache_hits = 0
+        self.response_cache_saved = 0.0
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        self.hedge_cost = 0.0
+        self.routing.clear()
+        self.cascade_saved = 0.0
+        self.is_running = True
+
+    def stop_tracking(self):
+        self.is_running = False
+
+    def is_current(self, task_id):
+        # False for requests of a run that has ended since they were sent
+        return task_id is None or task_id == self.task_id
+
+    def update_tokens(self, tokens_in, tokens_out, cached_tokens=0, cache_write_tokens=0, provider="", model=None, latency=0.0, task_id=None):
+        # cached_tokens and cache_write_tokens are the parts of tokens_in served from / written to the prompt cache.
+        # Returns the cost of this request, which is also appended to the ledger. task_id is the task
+        # that sent the request; if that run is over, the request only goes into the ledger.
+        model = model or self.current_model
+        cost = self.cost_for(tokens_in, tokens_out, cached_tokens, cache_write_tokens, model=model)
+        with self.lock:
+            current = self.is_current(task_id)
+            self.ledger.record(self.task_id if task_id is None else task_id, provider, model, tokens_in, tokens_out, cached_tokens, cache_write_tokens, latency, cost)
+            if current:
+                self.total_tokens_in += tokens_in
+                self.total_tokens_out += tokens_out
+                self.total_cached_tokens += cached_tokens
+                self.total_cache_write_tokens += cache_write_tokens
+                self.total_requests += 1
+                if cached_tokens:
+                    self.cache_hits += 1
+        return cost
+
+    def record_skipped_request(self):
+        # A model call avoided because the screen hadn't changed
+        with self.lock:
+            self.skipped_requests += 1
+
+    def record_response_cache_hit(self, saved_cost):
+        # A model call answered from the response cache; saved_cost is what the cached reply cost originally
+        with self.lock:
+            self.response_cache_hits += 1
+            self.response_cache_saved += saved_cost
+
+    def record_hedge(self):
+        # A secondary request sent because the primary was slow
+        with self.lock:
+            self.hedged_requests += 1
+
+    def record_hedge_win(self):
+        with self.lock:
+            self.hedge_wins += 1
+
+    def record_hedge_loss(self, cost, task_id=None):
+        # The request of a hedged step whose reply wasn't used; its cost is the spend the hedge added
+        with self.lock:
+            if self.is_current(task_id):
+                self.hedge_cost += cost
+
+    def record_routing(self, decision):
+        # One cascade step: the tiers tried with their outcome, the model that served it and the
+        # cost saved against sending it to the last tier right away (negative if escalations cost more)
+        with self.lock:
+            self.routing.append(decision)
+            self.cascade_saved += decision["saved"]
+
+    def _get_model_price(self):
+        return self.PRICES.get(self.current_model, self.PRICES["default"])
+
+    def cost_for(self, tokens_in, tokens_out, cached_tokens=0, cache_write_tokens=0, model=None):
+        # USD cost of the given token counts at the prices of `model` (default: the tracked model)
+        prices = self.PRICES.get(model or self.current_model, self.PRICES["default"])
+        uncached_in = tokens_in - cached_tokens - cache_write_tokens
+        return (uncached_in / 1_000_000) * prices["in"] + \
+               (cached_tokens / 1_000_000) * prices.get("cached", prices["in"]) + \
+               (cache_write_tokens / 1_000_000) * prices.get("cache_write", prices["in"]) + \
+               (tokens_out / 1_000_000) * prices["out"]
+
+    def _calculate_costs(self):
+        current_cost = self.cost_for(self.total_tokens_in, self.total_tokens_out, self.total_cached_tokens, self.total_cache_write_tokens)
+        
+        uptime = time.time() - self.start_time if self.start_time else 0
+        
+        if uptime > 0:
+            avg_hourly_cost = current_cost / (uptime / 3600)
+            avg_daily_cost = current_cost / (uptime / 86400)
+        else:
+            avg_hourly_cost = 0
+            avg_daily_cost = 0
+
+        return {
+            "current_cost": current_cost,
+            "hourly": avg_hourly_cost,
+            "daily": avg_daily_cost
+        }
+
+    def _calculate_stats(self):
+        uptime = time.time() - self.start_time if self.start_time else 0
+        rpm = (self.total_requests / uptime * 60) if uptime > 0 else 0
+        
+        return {
+            "uptime": uptime,
+            "rpm": rpm
+        }
+
+class TutorialCache:
+    """Keeps a local copy of the tutorial, revalidated against GitHub with ETag/Last-Modified."""
+
+    def __init__(self, url, ttl, timeout=30.0, cache_dir=CACHE_DIR):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.text_path = os.path.join(cache_dir, "tutorial.txt")
+        self.meta_path = os.path.join(cache_dir, "tutorial.json")
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write(self, path, text):
+        # Write to a temp file and swap it in, so a crash never leaves a half-written cache
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+    def load(self):
+        try:
+            with open(self.text_path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def is_stale(self):
+        return time.time() - self._load_meta().get("fetched_at", 0) > self.ttl
+
+    def refresh(self):
+        # Conditional GET; returns the new text if it changed, otherwise None
+        meta = self._load_meta()
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        if not os.path.exists(self.text_path):
+            headers = {}
+
+        # A short-lived session of its own: revalidation runs in the background and may outlive
+        # the run whose pooled provider sessions are closed at its end
+        with requests.Session() as session:
+            response = session.get(self.url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            meta["fetched_at"] = time.time()
+            self._write(self.meta_path, json.dumps(meta))
+            return None
+        response.raise_for_status()
+
+        self._write(self.text_path, response.text)
+        self._write(self.meta_path, json.dumps({
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time()
+        }))
+        return response.text
+
+class SpeechWorker:
+    """Speaks queued texts on a background thread so the agent doesn't wait for playback."""
+
+    def __init__(self, log, cache_dir, max_cache_bytes, default_lang="en"):
+        self.log = log
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.default_lang = default_lang
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def warm_up(self):
+        # Seed the detector so results are repeatable, and load its language profiles now
+        # rather than on the first "speak" action
+        langdetect.DetectorFactory.seed = 0
+        try:
+            langdetect.detect("warm up")
+        except langdetect.lang_detect_exception.LangDetectException:
+            pass
+
+    def speak(self, text):
+        self.queue.put(text)
+
+    def cancel_pending(self):
+        # Drops texts that haven't started playing yet
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _run(self):
+        while True:
+            text = self.queue.get()
+            try:
+                playsound(self._clip_for(text, self._detect_language(text)))
+            except Exception as e:
+                self.log(f"❌ Error during text-to-speech with gTTS: {e}")
+
+    def _detect_language(self, text):
+        try:
+            detected_lang = langdetect.detect(text)
+            self.log(f"     -> Detected language: {detected_lang}")
+            return detected_lang
+        except langdetect.lang_detect_exception.LangDetectException:
+            self.log(f"     -> Could not detect language. Defaulting to '{self.default_lang}'.")
+            return self.default_lang
+
+    def _clip_for(self, text, lang):
+        # Clips are content-addressed, so a phrase spoken before plays without another gTTS call
+        key = hashlib.sha256(f"{lang}\0{text}".encode("utf-8")).hexdigest()
+        path = os.path.join(self.cache_dir, key + ".mp3")
+        if os.path.exists(path):
+            # The modification time doubles as the last-played time for LRU eviction
+            os.utime(path)
+            self.log("     -> Playing cached audio...")
+            return path
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = path + ".tmp"
+        gTTS(text=text, lang=lang).save(temp_path)
+        os.replace(temp_path, path)
+        self._evict()
+        self.log("     -> Playing audio from Google TTS...")
+        return path
+
+    def _evict(self):
+        clips = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".mp3"):
+                stat = entry.stat()
+                clips.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in clips)
+        for _, size, path in sorted(clips):
+            if total <= self.max_cache_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_text_tokens(text):
+    # Approximates a BPE tokenizer: about one token per 4 characters of a word, one per punctuation mark
+    return sum((len(piece) + 3) // 4 if piece[0].isalnum() or piece[0] == "_" else 1 for piece in TOKEN_PATTERN.findall(text))
+
+class TokenBudget:
+    """Per-task and per-day token and cost caps, checked before each request."""
+
+    def __init__(self, cost_for, ledger=None, task_tokens=None, task_cost=None, day_tokens=None, day_cost=None, degrade_at=0.8, **_):
+        self.cost_for = cost_for
+        self.caps = {"task_tokens": task_tokens, "task_cost": task_cost, "day_tokens": day_tokens, "day_cost": day_cost}
+        self.degrade_at = degrade_at
+        # Today's totals come from the usage ledger so the day cap holds across runs
+        self.ledger = ledger
+        self.task_tokens = 0
+        self.task_cost = 0.0
+        self.day = self._load_day()
+
+    def _load_day(self):
+        today = datetime.date.today().isoformat()
+        if self.ledger is None:
+            return {"date": today, "tokens": 0, "cost": 0.0}
+        _, tokens, cost = self.ledger.day_totals(today)
+        return {"date": today, "tokens": tokens, "cost": cost}
+
+    def start_task(self):
+        self.task_tokens = 0
+        self.task_cost = 0.0
+        self.day = self._load_day()
+
+    def _usage(self, tokens, cost):
+        # Usage per cap if `tokens`/`cost` more were spent
+        return {
+            "task_tokens": self.task_tokens + tokens,
+            "task_cost": self.task_cost + cost,
+            "day_tokens": self.day["tokens"] + tokens,
+            "day_cost": self.day["cost"] + cost
+        }
+
+    def check(self, model, tokens_in, tokens_out):
+        # Returns ("ok" | "degrade" | "stop", name of the tightest cap) for a request of this size
+        usage = self._usage(tokens_in + tokens_out, self.cost_for(tokens_in, tokens_out, model=model))
+        verdict, tightest = "ok", None
+        for name, cap in self.caps.items():
+            if cap is None:
+                continue
+            if usage[name] > cap:
+                return "stop", name
+            if usage[name] > cap * self.degrade_at:
+                verdict, tightest = "degrade", name
+        return verdict, tightest
+
+    def record(self, tokens, cost):
+        self.task_tokens += tokens
+        self.task_cost += cost
+        if self.day["date"] != datetime.date.today().isoformat():
+            self.day = {"date": datetime.date.today().isoformat(), "tokens": 0, "cost": 0.0}
+        self.day["tokens"] += tokens
+        self.day["cost"] += cost
+
+    def describe(self):
+        parts = []
+        usage = self._usage(0, 0.0)
+        for name, cap in self.caps.items():
+            if cap is None:
+                continue
+            scope, unit = name.split("_")
+            if unit == "cost":
+                parts.append(f"{scope} ${usage[name]:.4f} of ${cap:.2f}")
+            else:
+                parts.append(f"{scope} {usage[name]} of {cap} tokens")
+        return "Budget: " + (", ".join(parts) if parts else "not set")
+
+class ProviderSessions:
+    """Keeps one pooled keep-alive HTTP session per provider for the length of an agent run."""
+
+    def __init__(self, pool_size=4, connect_timeout=5.0, read_timeout=120.0, compress=(), base_urls=None):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.compress = set(compress)
+        self.base_urls = dict(base_urls or {})
+        self.sessions = {}
+
+    def resolve(self, provider, url):
+        base = self.base_urls.get(provider)
+        if not base:
+            return url
+        parts = urllib.parse.urlsplit(url)
+        return base.rstrip("/") + url[len(f"{parts.scheme}://{parts.netloc}"):]
+
+    def session(self, provider):
+        session = self.sessions.get(provider)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self.sessions[provider] = session
+        return session
+
+    def post(self, provider, url, headers, body, stream=False):
+        if provider in self.compress:
+            body = gzip.compress(body, compresslevel=1)
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+        return self.session(provider).post(self.resolve(provider, url), headers=headers, data=body, timeout=self.timeout, stream=stream)
+
+    def get(self, provider, url, **kwargs):
+        return self.session(provider).get(self.resolve(provider, url), timeout=self.timeout, **kwargs)
+
+    def delete(self, provider, url, **kwargs):
+        return self.session(provider).delete(self.resolve(provider, url), timeout=self.timeout, **kwargs)
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+
+class HedgeCancelled(Exception):
+    """Raised from a hedged request's stream once the other request has won."""
+
+class HedgedRequest:
+    """One of the two racing requests of a hedged step."""
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.cancel = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.cost = None
+        self.lost = False
+        self.charged = False
+
+    def settle(self, cost=None, lost=False):
+        # The request reports its cost once it is booked, and the step marks it lost once the race
+        # is decided. Whichever comes last gets the loser's cost back, so it is counted exactly once.
+        with self.lock:
+            if cost is not None:
+                self.cost = cost
+            self.lost = self.lost or lost
+            if self.lost and self.cost is not None and not self.charged:
+                self.charged = True
+                return self.cost
+        return None
+
+class RateLimitError(Exception):
+    pass
+
+def parse_duration(value):
+    # Durations like "1s", "6m0s" or "20ms" as used in OpenAI's rate-limit headers
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+def retry_delay_from(res):
+    # Seconds the provider asks us to wait, from whichever header or body field it uses; None if it doesn't say
+    headers = res.headers
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        if retry_after.strip().isdigit():
+            return float(retry_after)
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    if headers.get("x-ratelimit-reset-requests"):
+        return parse_duration(headers["x-ratelimit-reset-requests"])
+    if headers.get("anthropic-ratelimit-requests-reset"):
+        try:
+            reset = datetime.datetime.fromisoformat(headers["anthropic-ratelimit-requests-reset"].replace("Z", "+00:00"))
+            return max(0.0, reset.timestamp() - time.time())
+        except ValueError:
+            pass
+    try:
+        # Gemini puts a RetryInfo with "retryDelay" in the error body
+        for detail in res.json().get("error", {}).get("details", []):
+            if "retryDelay" in detail:
+                return parse_duration(detail["retryDelay"])
+    except (ValueError, AttributeError):
+        pass
+    return None
+
+class RateLimiter:
+    """Token bucket in front of one provider/model, plus pauses requested by the provider."""
+
+    def __init__(self, rpm=None, burst=1):
+        # rpm None means no limit of our own; pauses still apply
+        self.rate = rpm / 60 if rpm else None
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _take(self):
+        # Takes a token if one is available; otherwise returns how long to wait for one
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.rate is None:
+                return 0.0
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, should_stop=lambda: False):
+        # Blocks until a request may be sent; returns False if should_stop() turned true meanwhile
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return True
+            if should_stop():
+                return False
+            time.sleep(min(wait, 0.2))
+
+    def pause(self, seconds):
+        # No request until `seconds` from now, and start again from an empty bucket
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.updated = self.blocked_until
+
+    def observe(self, res):
+        # Waits out the window early when the provider says no requests are left in it
+        remaining = res.headers.get("x-ratelimit-remaining-requests") or res.headers.get("anthropic-ratelimit-requests-remaining")
+        if remaining is not None and remaining.strip() == "0":
+            delay = retry_delay_from(res)
+            if delay:
+                self.pause(delay)
+
+class PayloadTemplate:
+    """A request body serialized once per run, with slots for the per-step images and prompt."""
+
+    def __init__(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.chunks = []
+        # Image index for each slot, or None for the prompt
+        self.slots = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(body):
+            self.chunks.append(body[position:match.start()])
+            self.slots.append(int(match.group(1)) if match.group(1) is not None else None)
+            position = match.end()
+        self.chunks.append(body[position:])
+
+    def render(self, images, prompt):
+        # The base64 frames are joined in as-is; only the prompt needs JSON escaping
+        prompt_bytes = json.dumps(prompt).encode("utf-8")[1:-1]
+        parts = []
+        for chunk, slot in zip(self.chunks, self.slots):
+            parts.append(chunk)
+            parts.append(prompt_bytes if slot is None else images[slot])
+        parts.append(self.chunks[-1])
+        return b"".join(parts)
+
+# Uniform result of a provider call. tokens_in counts every input token; cached_tokens and
+# cache_write_tokens are the parts of it read from / written to the provider's prompt cache.
+ProviderResult = collections.namedtuple("ProviderResult", ["text", "tokens_in", "tokens_out", "latency", "cached_tokens", "cache_write_tokens"], defaults=(0, 0))
+
+# Provider name -> adapter class, filled by @register_provider
+PROVIDER_ADAPTERS = {}
+
+def register_provider(adapter_class):
+    PROVIDER_ADAPTERS[adapter_class.name] = adapter_class
+    return adapter_class
+
+class ProviderAdapter:
+    """Base class for provider adapters: builds each request from a precompiled template and parses the reply."""
+
+    name = None
+
+    def __init__(self, http, model, api_key, tutorial, mime_type):
+        self.http = http
+        self.model = model
+        self.api_key = api_key
+        self.tutorial = tutorial
+        self.mime_type = mime_type
+        self._prepared = False
+        # (width, height) of the images in the current request, for token estimates
+        self.image_sizes = []
+        self.limiter = RateLimiter()
+        self.log = lambda message: None
+        self.latency = LatencyStats()
+        self._tutorial_tokens = None
+        # Templates are keyed by (image count, streaming); the count only changes in diff mode
+        self._templates = {}
+
+    def endpoint(self, stream=False):
+        raise NotImplementedError
+
+    def headers(self):
+        return {"Content-Type": "application/json"}
+
+    def prepare(self):
+        # One-time setup before the first request, e.g. uploading the tutorial to a provider cache
+        pass
+
+    def close(self):
+        # Releases anything prepare() created on the provider side
+        pass
+
+    def build_payload(self, image_count, stream=False):
+        # Static part of the request, with FRAME_PLACEHOLDER/PROMPT_PLACEHOLDER where the per-step data goes.
+        # The tutorial always comes first so providers can cache it as a prefix.
+        raise NotImplementedError
+
+    def parse_response(self, data, prompt, latency):
+        raise NotImplementedError
+
+    def parse_stream(self, res, prompt, on_text):
+        # Reads a streamed reply, passing each text delta to on_text; returns a ProviderResult without latency
+        raise NotImplementedError
+
+    def image_placeholders(self, image_count):
+        return [FRAME_PLACEHOLDER.format(i) for i in range(image_count)]
+
+    def image_tokens(self, width, height):
+        # Anthropic's formula, also a fair guess for providers that publish none
+        return (width * height + 749) // 750
+
+    def estimate_tokens_in(self, prompt, image_sizes=None):
+        # Input tokens of a request: tutorial and prompt through estimate_text_tokens plus the
+        # provider's image formula. Without image_sizes the sizes of the last estimate are reused,
+        # which is how the parsers fill in usage the provider didn't report.
+        if image_sizes is not None:
+            self.image_sizes = list(image_sizes)
+        if self._tutorial_tokens is None:
+            self._tutorial_tokens = estimate_text_tokens(self.tutorial)
+        return self._tutorial_tokens + estimate_text_tokens(prompt) + sum(self.image_tokens(width, height) for width, height in self.image_sizes)
+
+    def iter_events(self, res):
+        # Server-sent events: yields the decoded JSON of each data line
+        for line in res.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            yield json.loads(data)
+
+    def retry_delay(self, res, attempt):
+        # The provider's own delay if it gives one, otherwise exponential backoff; jittered either
+        # way so several clients don't retry in lockstep
+        delay = retry_delay_from(res)
+        if delay is None:
+            delay = min(RATE_LIMIT_SETTINGS["backoff_max"], RATE_LIMIT_SETTINGS["backoff_base"] * 2 ** attempt)
+            return delay * random.uniform(0.5, 1.0)
+        return delay + random.uniform(0, 1.0)
+
+    def send(self, images, prompt, on_text=None, should_stop=lambda: False):
+        # With on_text the reply is streamed and each text delta is handed over as it arrives
+        if not self._prepared:
+            self.prepare()
+            self._prepared = True
+
+        stream = on_text is not None
+        key = (len(images), stream)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = PayloadTemplate(self.build_payload(len(images), stream))
+        with self.latency.timer("render", self.name, self.model):
+            body = template.render(images, prompt)
+
+        max_retries = RATE_LIMIT_SETTINGS["max_retries"]
+        for attempt in range(max_retries + 1):
+            if not self.limiter.acquire(should_stop):
+                raise RateLimitError("Stopped while waiting for the rate limit.")
+            # "request" is upload plus waiting for the response headers (for unstreamed replies also
+            # the whole inference); "response" is reading and decoding the reply
+            start = time.perf_counter()
+            res = self.http.post(self.name, self.endpoint(stream), self.headers(), body, stream=stream)
+            self.latency.record("request", time.perf_counter() - start, self.name, self.model)
+            try:
+                if res.status_code in RATE_LIMIT_SETTINGS["retry_statuses"]:
+                    if attempt == max_retries:
+                        raise RateLimitError(f"{self.name} still returned HTTP {res.status_code} after {max_retries} retries.")
+                    delay = self.retry_delay(res, attempt)
+                    self.log(f"   -> {self.name} returned HTTP {res.status_code}, retrying in {delay:.1f}s...")
+                    self.limiter.pause(delay)
+                    continue
+                res.raise_for_status()
+                self.limiter.observe(res)
+                with self.latency.timer("response", self.name, self.model):
+                    if not stream:
+                        return self.parse_response(res.json(), prompt, time.perf_counter() - start)
+                    return self.parse_stream(res, prompt, on_text)._replace(latency=time.perf_counter() - start)
+            finally:
+                res.close()
+
+@register_provider
+class OllamaAdapter(ProviderAdapter):
+    name = "Ollama"
+
+    # How long Ollama keeps the model loaded after a request. While it stays loaded, the
+    # evaluated tutorial prefix is reused instead of being processed again every step.
+    keep_alive = "30m"
+
+    def endpoint(self, stream=False):
+        return "http://localhost:11434/api/generate"
+
+    def build_payload(self, image_count, stream=False):
+        return {
+            "model": self.model,
+            "prompt": f"{self.tutorial}\n\n{PROMPT_PLACEHOLDER}",
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+            "images": self.image_placeholders(image_count),
+            "options": {
+                "num_ctx": 4096
+            }
+        }
+
+    def image_tokens(self, width, height):
+        # LLaVA-style vision encoders turn every image into a fixed grid of 576 patches
+        return 576
+
+    def _result(self, text, data, prompt, latency):
+        # Ollama reports the evaluated token counts in the final object
+        return ProviderResult(text, data.get("prompt_eval_count", self.estimate_tokens_in(prompt)), data.get("eval_count", estimate_text_tokens(text)), latency)
+
+    def parse_response(self, data, prompt, latency):
+        return self._result(data.get("response", ""), data, prompt, latency)
+
+    def parse_stream(self, res, prompt, on_text):
+        # Newline-delimited JSON objects, the last one marked "done"
+        parts = []
+        chunk = {}
+        for line in res.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            delta = chunk.get("response", "")
+            if delta:
+                parts.append(delta)
+                on_text(delta)
+            if chunk.get("done"):
+                break
+        return self._result("".join(parts), chunk, prompt, 0)
+
+@register_provider
+class GeminiAdapter(ProviderAdapter):
+    name = "Gemini"
+
+    # Lifetime of the cached tutorial; it's deleted when the run ends anyway
+    cache_ttl = "3600s"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cached_content = None
+
+    def endpoint(self, stream=False):
+        if stream:
+            return f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:streamGenerateContent?alt=sse&key={self.api_key}"
+        return f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent?key={self.api_key}"
+
+    def prepare(self):
+        # Upload the tutorial once as cached content so steps only send the frame and prompt.
+        # Models have a minimum cacheable size; below it, or on any error, the tutorial stays inline.
+        url = f"https://generativelanguage.googleapis.com/v1beta/cachedContents?key={self.api_key}"
+        body = json.dumps({
+            "model": f"models/{self.model}",
+            "contents": [{"role": "user", "parts": [{"text": self.tutorial}]}],
+            "ttl": self.cache_ttl
+        }).encode("utf-8")
+        try:
+            res = self.http.post(self.name, url, self.headers(), body)
+            res.raise_for_status()
+            self.cached_content = res.json()["name"]
+        except (requests.exceptions.RequestException, KeyError, ValueError):
+            self.cached_content = None
+
+    def close(self):
+        if not self.cached_content:
+            return
+        try:
+            self.http.delete(self.name, f"https://generativelanguage.googleapis.com/v1beta/{self.cached_content}?key={self.api_key}")
+        except requests.exceptions.RequestException:
+            pass
+        self.cached_content = None
+
+    def build_payload(self, image_count, stream=False):
+        image_parts = [{"inline_data": {"mime_type": self.mime_type, "data": placeholder}} for placeholder in self.image_placeholders(image_count)]
+        if self.cached_content:
+            return {"cachedContent": self.cached_content, "contents": [{"role": "user", "parts": image_parts + [{"text": PROMPT_PLACEHOLDER}]}]}
+        return {"contents": [{"parts": [{"text": self.tutorial}] + image_parts + [{"text": PROMPT_PLACEHOLDER}]}]}
+
+    def image_tokens(self, width, height):
+        # Small images are 258 tokens; larger ones are tiled into 768x768 crops of 258 tokens each
+        if width <= 384 and height <= 384:
+            return 258
+        return -(-width // 768) * -(-height // 768) * 258
+
+    def _result(self, text, usage, prompt, latency):
+        return ProviderResult(
+            text,
+            usage.get("promptTokenCount", self.estimate_tokens_in(prompt)),
+            usage.get("candidatesTokenCount", estimate_text_tokens(text)),
+            latency,
+            usage.get("cachedContentTokenCount", 0)
+        )
+
+    def parse_response(self, data, prompt, latency):
+        text = data["candidates"][0]["content"]["parts"][0]["text"]
+        return self._result(text, data.get("usageMetadata", {}), prompt, latency)
+
+    def parse_stream(self, res, prompt, on_text):
+        parts = []
+        usage = {}
+        for event in self.iter_events(res):
+            for part in event.get("candidates", [{}])[0].get("content", {}).get("parts", []):
+                delta = part.get("text", "")
+                if delta:
+                    parts.append(delta)
+                    on_text(delta)
+            # Usage is cumulative, the last event has the totals
+            usage = event.get("usageMetadata", usage)
+        return self._result("".join(parts), usage, prompt, 0)
+
+class ChatCompletionsAdapter(ProviderAdapter):
+    """Shared request layout and response handling for OpenAI-style chat completion endpoints."""
+
+    def build_messages(self, image_count):
+        # The tutorial goes in a system message that never changes within a run,
+        # which makes it a stable prefix for the provider's automatic prompt caching
+        image_parts = [{"type": "image_url", "image_url": {"url": f"data:{self.mime_type};base64,{placeholder}"}} for placeholder in self.image_placeholders(image_count)]
+        return [
+            {"role": "system", "content": self.tutorial},
+            {"role": "user", "content": [
+                {"type": "text", "text": PROMPT_PLACEHOLDER}
+            ] + image_parts}
+        ]
+
+    def _result(self, text, usage, prompt, latency):
+        # Use the reported usage when available, otherwise estimate
+        if not usage:
+            return ProviderResult(text, self.estimate_tokens_in(prompt), estimate_text_tokens(text), latency)
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        return ProviderResult(text, usage["prompt_tokens"], usage["completion_tokens"], latency, cached)
+
+    def parse_response(self, data, prompt, latency):
+        return self._result(data["choices"][0]["message"]["content"], data.get("usage"), prompt, latency)
+
+    def parse_stream(self, res, prompt, on_text):
+        parts = []
+        usage = None
+        for event in self.iter_events(res):
+            for choice in event.get("choices", []):
+                delta = choice.get("delta", {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    on_text(delta)
+            # Only the final chunk carries usage
+            usage = event.get("usage") or usage
+        return self._result("".join(parts), usage, prompt, 0)
+
+@register_provider
+class OpenRouterAdapter(ChatCompletionsAdapter):
+    name = "OpenRouter"
+
+    def endpoint(self, stream=False):
+        return "https://openrouter.ai/api/v1/chat/completions"
+
+    def headers(self):
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def build_payload(self, image_count, stream=False):
+        payload = {
+            "model": self.model,
+            "messages": self.build_messages(image_count)
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+@register_provider
+class OpenAIAdapter(ChatCompletionsAdapter):
+    name = "OpenAI"
+
+    def endpoint(self, stream=False):
+        return "https://api.openai.com/v1/chat/completions"
+
+    def image_tokens(self, width, height):
+        # High detail: fit into 2048x2048, shrink the short side to 768, then 170 per 512px tile plus 85
+        scale = min(1.0, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, 768 / min(width, height))
+        width, height = width * scale, height * scale
+        return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+    def headers(self):
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+
+    def build_payload(self, image_count, stream=False):
+        payload = {
+            "model": self.model,
+            "messages": self.build_messages(image_count),
+            "max_tokens": 4096
+        }
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+@register_provider
+class ClaudeAdapter(ProviderAdapter):
+    name = "Claude"
+
+    def endpoint(self, stream=False):
+        return "https://api.anthropic.com/v1/messages"
+
+    def headers(self):
+        return {
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01",
+            "Content-Type": "application/json"
+        }
+
+    def build_payload(self, image_count, stream=False):
+        # The tutorial is a system block marked as a cache breakpoint, so after the first
+        # step it is read from Anthropic's prompt cache instead of being billed in full
+        image_parts = [{"type": "image", "source": {"type": "base64", "media_type": self.mime_type, "data": placeholder}} for placeholder in self.image_placeholders(image_count)]
+        payload = {
+            "model": self.model,
+            "max_tokens": 4096,
+            "system": [
+                {"type": "text", "text": self.tutorial, "cache_control": {"type": "ephemeral"}}
+            ],
+            "messages": [
+                {
+                    "role": "user",
+                    "content": image_parts + [
+                        {"type": "text", "text": PROMPT_PLACEHOLDER}
+                    ]
+                }
+            ]
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def _result(self, text, usage, tokens_out, latency):
+        # input_tokens excludes cache reads and writes; count them all as input
+        cached = usage.get("cache_read_input_tokens") or 0
+        cache_write = usage.get("cache_creation_input_tokens") or 0
+        return ProviderResult(text, usage["input_tokens"] + cached + cache_write, tokens_out, latency, cached, cache_write)
+
+    def parse_response(self, data, prompt, latency):
+        return self._result(data["content"][0]["text"], data["usage"], data["usage"]["output_tokens"], latency)
+
+    def parse_stream(self, res, prompt, on_text):
+        parts = []
+        usage = {"input_tokens": 0}
+        tokens_out = 0
+        for event in self.iter_events(res):
+            event_type = event.get("type")
+            if event_type == "message_start":
+                usage = event["message"]["usage"]
+            elif event_type == "content_block_delta":
+                delta = event["delta"].get("text", "")
+                if delta:
+                    parts.append(delta)
+                    on_text(delta)
+            elif event_type == "message_delta":
+                tokens_out = event.get("usage", {}).get("output_tokens", tokens_out)
+            elif event_type == "message_stop":
+                break
+        return self._result("".join(parts), usage, tokens_out, 0)
+
+class ActionStreamParser:
+    """Parses a streamed JSON action list incrementally, returning each action object as soon as it closes."""
+
+    def __init__(self):
+        self.started = False
+        self.done = False
+        self.error = None
+        self.actions = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._current = []
+        self._prefix = ""
+
+    def feed(self, text):
+        completed = []
+        for char in text:
+            if self.done:
+                break
+            if not self.started:
+                # Only whitespace or a ```json fence may come before the array. Anything else is prose,
+                # so stop here and leave the reply to _parse_actions once it has fully arrived
+                if char == "[":
+                    self.started = True
+                    self._depth = 1
+                    continue
+                self._prefix += char
+                if not "```json".startswith(self._prefix.strip().lower()):
+                    self.done = True
+                continue
+
+            if self._depth >= 2:
+                self._current.append(char)
+                if self._in_string:
+                    if self._escape:
+                        self._escape = False
+                    elif char == "\\":
+                        self._escape = True
+                    elif char == '"':
+                        self._in_string = False
+                    continue
+                if char == '"':
+                    self._in_string = True
+                elif char in "{[":
+                    self._depth += 1
+                elif char in "}]":
+                    self._depth -= 1
+                    if self._depth == 1:
+                        try:
+                            action = json.loads("".join(self._current))
+                        except ValueError as e:
+                            self.error = e
+                            self.done = True
+                            break
+                        self._current = []
+                        self.actions.append(action)
+                        completed.append(action)
+            elif char == "{":
+                self._current.append(char)
+                self._depth = 2
+            elif char == "]":
+                self.done = True
+        return completed
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class LatencyStats:
+    """Rolling latency samples per provider, model and agent loop stage."""
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = {}
+        # Run-wide (count, sum) per key, as Prometheus summaries expect
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds, provider="", model=""):
+        key = (provider, model, stage)
+        with self.lock:
+            samples = self.samples.get(key)
+            if samples is None:
+                samples = self.samples[key] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+            count, total = self.totals.get(key, (0, 0.0))
+            self.totals[key] = (count + 1, total + seconds)
+
+    def quantile(self, stage, fraction, provider="", model=""):
+        # (value, number of samples) over one stage's recent samples
+        with self.lock:
+            values = sorted(self.samples.get((provider, model, stage), ()))
+        return percentile(values, fraction), len(values)
+
+    @contextlib.contextmanager
+    def timer(self, stage, provider="", model=""):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, provider, model)
+
+    def snapshot(self):
+        with self.lock:
+            items = [(key, sorted(samples), self.totals[key]) for key, samples in self.samples.items()]
+        snapshot = []
+        for (provider, model, stage), values, (count, total) in sorted(items):
+            entry = {"provider": provider, "model": model, "stage": stage, "count": count, "sum": total}
+            for quantile in self.QUANTILES:
+                entry[f"p{round(quantile * 100)}"] = percentile(values, quantile)
+            snapshot.append(entry)
+        return snapshot
+
+    def to_prometheus(self):
+        def label(value):
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines = [
+            "# HELP aiport_stage_seconds Time spent in each stage of the agent loop.",
+            "# TYPE aiport_stage_seconds summary"
+        ]
+        for entry in self.snapshot():
+            labels = f'provider="{label(entry["provider"])}",model="{label(entry["model"])}",stage="{label(entry["stage"])}"'
+            for quantile in self.QUANTILES:
+                lines.append(f'aiport_stage_seconds{{{labels},quantile="{quantile}"}} {entry[f"p{round(quantile * 100)}"]:.6f}')
+            lines.append(f"aiport_stage_seconds_sum{{{labels}}} {entry['sum']:.6f}")
+            lines.append(f"aiport_stage_seconds_count{{{labels}}} {entry['count']}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        return json.dumps({"generated_at": time.time(), "stages": self.snapshot()}, indent=2)
+
+    def export(self, directory):
+        # Written to temp files and swapped in, so scrapers never read half a file
+        os.makedirs(directory, exist_ok=True)
+        for filename, text in (("metrics.prom", self.to_prometheus()), ("metrics.json", self.to_json())):
+            path = os.path.join(directory, filename)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(path + ".tmp", path)
+
+class ScreenStabilityDetector:
+    """Waits for the screen to stop changing instead of sleeping for a fixed time."""
+
+    def __init__(self, sample_interval=0.05, stable_samples=3, tolerance=1.0, min_wait=0.05, max_wait=5.0, sample_edge=256):
+        self.sample_interval = sample_interval
+        # The screen counts as settled after this many consecutive samples whose mean
+        # grayscale difference to the previous one is at most `tolerance`
+        self.stable_samples = stable_samples
+        self.tolerance = tolerance
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        # Samples are compared downscaled to about this long edge
+        self.sample_edge = sample_edge
+        # Measured settle times per kind ("action" or "step"), as (seconds, timed_out)
+        self.history = collections.defaultdict(lambda: collections.deque(maxlen=500))
+
+    def _small(self, image):
+        factor = max(1, max(image.size) // self.sample_edge)
+        return np.asarray(image.reduce(factor).convert("L"), dtype=np.int16)
+
+    def wait(self, grab, kind, should_stop=lambda: False):
+        # Samples the screen with grab() until it is stable; returns (seconds waited, last sample)
+        start = time.time()
+        previous = None
+        stable = 0
+        while True:
+            image = grab()
+            current = self._small(image)
+            if previous is not None and previous.shape == current.shape and np.abs(current - previous).mean() <= self.tolerance:
+                stable += 1
+            else:
+                stable = 0
+            previous = current
+
+            elapsed = time.time() - start
+            settled = stable >= self.stable_samples and elapsed >= self.min_wait
+            if settled or elapsed >= self.max_wait or should_stop():
+                break
+            time.sleep(self.sample_interval)
+
+        self.history[kind].append((elapsed, not settled))
+        return elapsed, image
+
+    def stats(self):
+        # p50/p95/max settle time and number of timeouts per kind, for tuning the thresholds
+        stats = {}
+        for kind, samples in self.history.items():
+            times = sorted(elapsed for elapsed, _ in samples)
+            stats[kind] = {
+                "count": len(times),
+                "p50": percentile(times, 0.5),
+                "p95": percentile(times, 0.95),
+                "max": times[-1] if times else 0.0,
+                "timeouts": sum(1 for _, timed_out in samples if timed_out)
+            }
+        return stats
+
+class FrameGate:
+    """Decides whether a new frame differs enough from the last submitted one to be worth a model call."""
+
+    def __init__(self, threshold=2, hash_size=16, sample_edge=480, tolerance=24, min_changed_pixels=12, poll_interval=0.25, max_wait=2.0):
+        # Frames whose hash differs from the last submitted one by fewer than `threshold` bits
+        # are compared pixel by pixel on a downscaled copy before they count as unchanged
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.sample_edge = sample_edge
+        self.tolerance = tolerance
+        self.min_changed_pixels = min_changed_pixels
+        # How often to re-poll the screen locally, and how long to wait before sending anyway
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.last_hash = None
+        self.last_thumbnail = None
+
+    def reset(self):
+        self.last_hash = None
+        self.last_thumbnail = None
+
+    def compute_hash(self, image):
+        # dHash: shrink to (hash_size + 1) x hash_size grayscale and compare neighbouring pixels
+        small = image.resize((self.hash_size + 1, self.hash_size), Image.Resampling.BOX).convert("L")
+        pixels = small.tobytes()
+        row_len = self.hash_size + 1
+        frame_hash = 0
+        for row in range(self.hash_size):
+            offset = row * row_len
+            for col in range(self.hash_size):
+                frame_hash = (frame_hash << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+        return frame_hash
+
+    def distance(self, hash_a, hash_b):
+        return bin(hash_a ^ hash_b).count("1")
+
+    def thumbnail(self, image):
+        # Grayscale copy with a long edge of about sample_edge pixels
+        factor = max(1, max(image.size) // self.sample_edge)
+        return np.asarray(image.reduce(factor).convert("L"))
+
+    def differs(self, thumbnail_a, thumbnail_b):
+        # Pixel-level check between two thumbnails; a 16x16 hash doesn't see a line of typed text
+        if thumbnail_a is None or thumbnail_b is None or thumbnail_a.shape != thumbnail_b.shape:
+            return True
+        changed = (np.maximum(thumbnail_a, thumbnail_b) - np.minimum(thumbnail_a, thumbnail_b)) > self.tolerance
+        return int(changed.sum()) >= self.min_changed_pixels
+
+    def has_changed(self, frame_hash, image):
+        if self.last_hash is None:
+            return True
+        if self.distance(frame_hash, self.last_hash) >= self.threshold:
+            return True
+        return self.differs(self.thumbnail(image), self.last_thumbnail)
+
+    def mark_submitted(self, frame_hash, image):
+        self.last_hash = frame_hash
+        self.last_thumbnail = self.thumbnail(image)
+
+class FrameDiffer:
+    """Finds the screen regions that changed since the last submitted frame."""
+
+    def __init__(self, tile_size=32, tolerance=24, max_changed_ratio=0.4, max_regions=4, thumbnail_edge=512):
+        self.tile_size = tile_size
+        # Grayscale difference a pixel must exceed to count as changed
+        self.tolerance = tolerance
+        # Past this share of changed tiles, or this many separate regions, the full frame is sent instead
+        self.max_changed_ratio = max_changed_ratio
+        self.max_regions = max_regions
+        # Longest edge of the low-res context thumbnail sent alongside the crops
+        self.thumbnail_edge = thumbnail_edge
+        self.last_frame = None
+        self._current_frame = None
+
+    def reset(self):
+        self.last_frame = None
+        self._current_frame = None
+
+    def changed_regions(self, image):
+        # Returns (left, top, right, bottom) boxes in screen pixels,
+        # or None when there's nothing to diff against or too much has changed
+        current = np.asarray(image.convert("L"))
+        self._current_frame = current
+        previous = self.last_frame
+        if previous is None or previous.shape != current.shape:
+            return None
+
+        size = self.tile_size
+        height, width = current.shape
+        rows = -(-height // size)
+        cols = -(-width // size)
+
+        # uint8-safe absolute difference, then collapse each tile to "any pixel changed"
+        changed = (np.maximum(current, previous) - np.minimum(current, previous)) > self.tolerance
+        padded = np.zeros((rows * size, cols * size), dtype=bool)
+        padded[:height, :width] = changed
+        tiles = padded.reshape(rows, size, cols, size).any(axis=(1, 3))
+
+        if tiles.mean() > self.max_changed_ratio:
+            return None
+        if not tiles.any():
+            return []
+
+        boxes = self._merge_overlapping([
+            (max(c0 - 1, 0), max(r0 - 1, 0), min(c1 + 1, cols), min(r1 + 1, rows))
+            for c0, r0, c1, r1 in self._group_tiles(tiles)
+        ])
+        if len(boxes) > self.max_regions:
+            # Too fragmented to be worth separate crops; send their union instead
+            boxes = [(min(b[0] for b in boxes), min(b[1] for b in boxes),
+                      max(b[2] for b in boxes), max(b[3] for b in boxes))]
+
+        return [(c0 * size, r0 * size, min(c1 * size, width), min(r1 * size, height)) for c0, r0, c1, r1 in boxes]
+
+    def mark_submitted(self):
+        self.last_frame = self._current_frame
+
+    def _group_tiles(self, tiles):
+        # Changed tiles touching each other (8-neighbourhood) form one region, as tile-grid boxes
+        grid = tiles.tolist()
+        rows, cols = len(grid), len(grid[0])
+        seen = [[False] * cols for _ in range(rows)]
+        boxes = []
+        for row in range(rows):
+            for col in range(cols):
+                if not grid[row][col] or seen[row][col]:
+                    continue
+                seen[row][col] = True
+                stack = [(row, col)]
+                r0 = r1 = row
+                c0 = c1 = col
+                while stack:
+                    y, x = stack.pop()
+                    r0, r1 = min(r0, y), max(r1, y)
+                    c0, c1 = min(c0, x), max(c1, x)
+                    for ny in range(max(y - 1, 0), min(y + 2, rows)):
+                        for nx in range(max(x - 1, 0), min(x + 2, cols)):
+                            if grid[ny][nx] and not seen[ny][nx]:
+                                seen[ny][nx] = True
+                                stack.append((ny, nx))
+                boxes.append((c0, r0, c1 + 1, r1 + 1))
+        return boxes
+
+    def _merge_overlapping(self, boxes):
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(boxes)):
+                for j in range(i + 1, len(boxes)):
+                    a, b = boxes[i], boxes[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        boxes[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                        del boxes[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return boxes
+
+class ResponseCache:
+    """Model replies stored on disk by screen state, prompt, tutorial version and model."""
+
+    def __init__(self, dir, max_bytes, ttl, hash_size=16, sample_edge=240, crop=None):
+        self.dir = dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.crop = crop
+        self.hasher = FrameGate(hash_size=hash_size, sample_edge=sample_edge)
+        # Hashing the tutorial every step is wasted work, it only changes between runs
+        self._tutorial_version = (None, None)
+
+    def tutorial_version(self, tutorial):
+        if self._tutorial_version[0] is not tutorial:
+            self._tutorial_version = (tutorial, hashlib.sha256(tutorial.encode("utf-8")).hexdigest()[:16])
+        return self._tutorial_version[1]
+
+    def key(self, frame, prompt, tutorial, provider, model, frame_sizes):
+        # The submitted image size is part of the key, since the coordinates in a reply are in its pixels
+        if self.crop:
+            width, height = frame.size
+            left, top, right, bottom = self.crop
+            frame = frame.crop((round(left * width), round(top * height), round(right * width), round(bottom * height)))
+        # The hash alone misses small changes, so the quantized thumbnail pins down the exact screen
+        pixels = hashlib.sha256((self.hasher.thumbnail(frame) >> 4).tobytes()).hexdigest()[:16]
+        parts = [f"{self.hasher.compute_hash(frame):x}", pixels, prompt, self.tutorial_version(tutorial), provider, model, [list(size) for size in frame_sizes]]
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.dir, key + ".json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if time.time() - entry["created"] > self.ttl:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            return None
+        # The modification time doubles as the last-used time for LRU eviction
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return entry
+
+    def put(self, key, result):
+        os.makedirs(self.dir, exist_ok=True)
+        path = os.path.join(self.dir, key + ".json")
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"response": result.text, "tokens_in": result.tokens_in, "tokens_out": result.tokens_out, "created": time.time()}, f)
+        os.replace(temp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+class MacroStore:
+    """Action sequences of successful runs, one JSON file per command."""
+
+    def __init__(self, dir, **_):
+        self.dir = dir
+
+    def _path(self, prompt):
+        normalized = " ".join(prompt.lower().split())
+        return os.path.join(self.dir, hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:32] + ".json")
+
+    def load(self, prompt):
+        try:
+            with open(self._path(prompt), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self, prompt, steps):
+        # The latest successful run replaces the previous macro for the command
+        os.makedirs(self.dir, exist_ok=True)
+        path = self._path(prompt)
+        previous = self.load(prompt) or {}
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"prompt": prompt, "saved": time.time(), "runs": previous.get("runs", 0) + 1, "steps": steps}, f)
+        os.replace(temp_path, path)
+
+class SessionRecorder:
+    """Writes each step of a run into one zip archive, frames as keyframes plus changed tiles."""
+
+    # Delta tiles of one frame are packed into an atlas this many tiles wide
+    ATLAS_COLUMNS = 64
+
+    def __init__(self, path, metadata, tutorial, tile_size=32, keyframe_interval=30, max_delta_ratio=0.5, log=None, **_):
+        self.path = path
+        self.log = log or (lambda message: sys.stderr.write(message + "\n"))
+        self.metadata = dict(metadata, started=time.time(), tile_size=tile_size)
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self.max_delta_ratio = max_delta_ratio
+        self.steps = 0
+        self._previous = None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.archive = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+        self.archive.writestr("tutorial.txt", tutorial or "")
+        # Encoding frames takes a while on large screens, so it happens off the agent loop
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def record_step(self, frame, step):
+        self.queue.put((frame, step))
+
+    def close(self):
+        # Writes the pending steps and the session index; returns the number of steps recorded
+        self.queue.put(None)
+        self.writer.join()
+        self.metadata["steps"] = self.steps
+        self.archive.writestr("session.json", json.dumps(self.metadata))
+        self.archive.close()
+        return self.steps
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            frame, step = item
+            try:
+                number = self.steps + 1
+                step["frame"] = self._write_frame(number, frame)
+                self.archive.writestr(f"steps/{number:06d}.json", json.dumps(step))
+                self.steps = number
+            except (OSError, ValueError) as e:
+                self.log(f"Error recording session step: {e}")
+
+    def _write_png(self, name, pixels):
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="PNG")
+        # PNG is already compressed; deflating it again only costs time
+        self.archive.writestr(name, buffer.getvalue(), compress_type=zipfile.ZIP_STORED)
+
+    def _write_frame(self, number, frame):
+        pixels = np.asarray(frame.convert("RGB"))
+        previous, self._previous = self._previous, pixels
+        name = f"frames/{number:06d}.png"
+        if previous is None or previous.shape != pixels.shape or (number - 1) % self.keyframe_interval == 0:
+            self._write_png(name, pixels)
+            return {"type": "key", "file": name}
+
+        size = self.tile_size
+        height, width, _ = pixels.shape
+        rows, cols = -(-height // size), -(-width // size)
+        changed = np.zeros((rows * size, cols * size), dtype=bool)
+        changed[:height, :width] = (pixels != previous).any(axis=2)
+        tiles = np.argwhere(changed.reshape(rows, size, cols, size).any(axis=(1, 3)))
+        if len(tiles) > self.max_delta_ratio * rows * cols:
+            self._write_png(name, pixels)
+            return {"type": "key", "file": name}
+        if not len(tiles):
+            return {"type": "delta", "file": None, "tiles": []}
+
+        padded = np.zeros((rows * size, cols * size, 3), dtype=np.uint8)
+        padded[:height, :width] = pixels
+        atlas_cols = min(len(tiles), self.ATLAS_COLUMNS)
+        atlas = np.zeros((-(-len(tiles) // atlas_cols) * size, atlas_cols * size, 3), dtype=np.uint8)
+        for index, (row, col) in enumerate(tiles):
+            atlas_row, atlas_col = divmod(index, atlas_cols)
+            atlas[atlas_row * size:(atlas_row + 1) * size, atlas_col * size:(atlas_col + 1) * size] = padded[row * size:(row + 1) * size, col * size:(col + 1) * size]
+        self._write_png(name, atlas)
+        return {"type": "delta", "file": name, "tiles": tiles.tolist()}
+
+class ReplaySession:
+    """Reads a recorded session back: the frames in order and the model's recorded replies."""
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = zipfile.ZipFile(path)
+        self.metadata = json.loads(self.archive.read("session.json"))
+        self.tutorial = self.archive.read("tutorial.txt").decode("utf-8")
+        names = sorted(name for name in self.archive.namelist() if name.startswith("steps/"))
+        self.steps = [json.loads(self.archive.read(name)) for name in names]
+        if not self.steps:
+            raise ValueError(f"{path} contains no recorded steps")
+        self.tile_size = self.metadata["tile_size"]
+        # Index of the step whose frame is currently "on screen"
+        self.position = 0
+        self._decoded = -1
+        self._pixels = None
+        self._lock = threading.Lock()
+
+    def frame(self):
+        # The recorded screen for the current step; stays on the last frame once the recording ends
+        with self._lock:
+            index = min(self.position, len(self.steps) - 1)
+            while self._decoded < index:
+                self._decoded += 1
+                self._apply(self.steps[self._decoded]["frame"])
+            return Image.fromarray(self._pixels)
+
+    def next_step(self):
+        # The recorded step for the frame on screen, moving on to the next frame; None past the end
+        with self._lock:
+            if self.position >= len(self.steps):
+                return None
+            step = self.steps[self.position]
+            self.position += 1
+            return step
+
+    def close(self):
+        self.archive.close()
+
+    def _apply(self, info):
+        if info["file"] is None:
+            return
+        with Image.open(io.BytesIO(self.archive.read(info["file"]))) as image:
+            data = np.asarray(image.convert("RGB"))
+        if info["type"] == "key":
+            self._pixels = data.copy()
+            return
+        size = self.tile_size
+        height, width, _ = self._pixels.shape
+        atlas_cols = data.shape[1] // size
+        for index, (row, col) in enumerate(info["tiles"]):
+            atlas_row, atlas_col = divmod(index, atlas_cols)
+            top, left = row * size, col * size
+            tile_height, tile_width = min(size, height - top), min(size, width - left)
+            self._pixels[top:top + tile_height, left:left + tile_width] = data[atlas_row * size:atlas_row * size + tile_height, atlas_col * size:atlas_col * size + tile_width]
+
+class ReplayAdapter(ProviderAdapter):
+    """Answers each step with the response recorded for it instead of calling a provider."""
+
+    name = "Replay"
+
+    def __init__(self, session, replay_latency=False):
+        super().__init__(None, session.metadata["model"], "", session.tutorial, "image/png")
+        self.session = session
+        self.replay_latency = replay_latency
+
+    def send(self, images, prompt, on_text=None, should_stop=lambda: False):
+        step = self.session.next_step()
+        if step is None:
+            # Out of recorded steps: tell the loop the task is complete
+            return ProviderResult("[]", 0, 0, 0.0)
+        if self.replay_latency:
+            time.sleep(step["latency"])
+        text = step["response"]
+        if on_text is not None:
+            # Re-stream in small pieces so the incremental parser runs as it did live
+            for start in range(0, len(text), 16):
+                on_text(text[start:start + 16])
+        return ProviderResult(text, step["tokens_in"], step["tokens_out"], step["latency"], step["cached_tokens"])
+
+class NullInput:
+    """Stands in for pyautogui during a replay, so recorded actions never reach the desktop."""
+
+    def __init__(self, size):
+        self._size = size
+
+    def position(self):
+        return (0, 0)
+
+    def size(self):
+        return self._size
+
+    def __getattr__(self, name):
+        # moveTo, click, hotkey, typewrite, ... all do nothing
+        return lambda *args, **kwargs: None
+
+class AgentEngine:
+    """The capture/infer/execute loop, without any UI.
+
+    Settings are plain attributes read once when run() starts. Everything the loop reports goes
+    to on_event as a dict with an "event" name and a "ts" timestamp: "started", "log", "step",
+    "action", "error" and a final "finished" with the reason the run ended.
+    """
+
+    def __init__(self, usage_monitor=None, on_event=None, input_backend=None):
+        self.on_event = on_event
+        # pyautogui unless given; imported on first use so replays and imports don't need a display
+        self.input_backend = input_backend
+        self.provider = "Ollama"
+        self.model = "llama3"
+        self.api_key = ""
+        self.prompt = ""
+        self.diff_mode = False
+        self.stream_mode = False
+        self.settle_mode = False
+        self.timing_profile = "human"
+        self.record_mode = False
+        self.response_cache_mode = False
+        self.macro_mode = False
+        self.hedge_mode = False
+        self.cascade_mode = False
+
+        self.stop_flag = False
+        self.last_screenshot = None
+        self.tutorial_content = None
+        self.cursor_image = None
+        # Reused between steps so encoding doesn't reallocate a new buffer every frame
+        self._frame_buffer = io.BytesIO()
+        self.usage_monitor = usage_monitor or UsageTracker()
+        self.usage_monitor.ledger.log = self.log
+        self.budget = self.usage_monitor.budget = TokenBudget(self.usage_monitor.cost_for, self.usage_monitor.ledger, **BUDGET_SETTINGS)
+        # 0 = full quality, 1 = smaller images, 2 = smaller images and a shortened tutorial
+        self.budget_level = 0
+        self.frame_gate = FrameGate(**FRAME_GATE_SETTINGS)
+        self.http = ProviderSessions(**HTTP_SETTINGS)
+        self.adapter = None
+        self.tutorial_cache = TutorialCache(TUTORIAL_SETTINGS["url"], TUTORIAL_SETTINGS["ttl"], TUTORIAL_SETTINGS["timeout"])
+        self.frame_differ = FrameDiffer()
+        self.stability_detector = ScreenStabilityDetector()
+        self.timing = TIMING_PROFILES["human"]
+        self.speech = SpeechWorker(self.log, **SPEECH_SETTINGS)
+        threading.Thread(target=self.speech.warm_up, daemon=True).start()
+        # (left, top, scale) of each image in the current request, used to map
+        # coordinates returned by the model back to the screen
+        self.frame_regions = [(0, 0, 1.0)]
+        self.frame_sizes = []
+        # One rate limiter per (provider, model), kept across adapter rebuilds
+        self.rate_limiters = {}
+        # Where actions go and frames come from: the real desktop, or a recorded session when replaying
+        self.input = None
+        self.replay = None
+        self.recorder = None
+        self.response_cache = ResponseCache(**RESPONSE_CACHE_SETTINGS)
+        self.macros = MacroStore(**MACRO_SETTINGS)
+        self.macro = None
+        self.hedge_adapter = None
+        # Requests of hedged steps, joined or abandoned at the end of the run
+        self._hedged_requests = []
+        self.tier_adapters = {}
+        self.encoding_profile = dict(ENCODING_PROFILES["default"])
+
+        # Screenshots are taken without a cursor if the image is missing
+        try:
+            self.cursor_image = Image.open("cursor.png").convert("RGBA")
+        except FileNotFoundError:
+            pass
+
+    def emit(self, event, **fields):
+        # Called from the loop and its worker threads
+        if self.on_event is not None:
+            self.on_event(dict(event=event, ts=time.time(), **fields))
+
+    def log(self, message):
+        self.emit("log", message=message)
+
+    def desktop(self):
+        if self.input_backend is None:
+            import pyautogui
+            self.input_backend = pyautogui
+        return self.input_backend
+
+    def stop(self):
+        # Safe to call from any thread; run() winds down after the current stage
+        self.stop_flag = True
+        self.speech.cancel_pending()
+
+    def _get_encoding_profile(self):
+        provider_profile = ENCODING_PROFILES.get(self.provider, ENCODING_PROFILES["default"])
+        profile = {key: value for key, value in provider_profile.items() if key != "models"}
+        profile.update(provider_profile.get("models", {}).get(self.model, {}))
+        if self.budget_level >= 1:
+            # Close to a budget cap: send smaller images
+            for key in ("max_edge", "max_short_edge"):
+                if key in profile:
+                    profile[key] = int(profile[key] * BUDGET_SETTINGS["degraded_image_scale"])
+            if "max_pixels" in profile:
+                profile["max_pixels"] = int(profile["max_pixels"] * BUDGET_SETTINGS["degraded_image_scale"] ** 2)
+        return profile
+
+    def _fit_to_profile(self, image, profile):
+        # Downscale so the provider won't resize the image again on its side; returns (image, scale)
+        width, height = image.size
+        scale = min(1.0, profile.get("max_edge", max(width, height)) / max(width, height))
+        if "max_short_edge" in profile:
+            scale = min(scale, profile["max_short_edge"] / min(width, height))
+        if "max_pixels" in profile:
+            scale = min(scale, math.sqrt(profile["max_pixels"] / (width * height)))
+        if scale >= 1.0:
+            return image, 1.0
+        new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return image.resize(new_size, Image.Resampling.BILINEAR, reducing_gap=2.0), scale
+
+    def _encode_image(self, image):
+        # Encode straight from the PIL image into the reusable buffer and base64 it once.
+        # The result stays as bytes; it is spliced into the request body by PayloadTemplate.render.
+        profile = self.encoding_profile
+        image_format = profile.get("format", "PNG")
+        if profile.get("grayscale"):
+            image = image.convert("L")
+        elif profile.get("palette") and image_format == "PNG":
+            image = image.quantize(colors=profile["palette"])
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        save_options = {}
+        if image_format in ("JPEG", "WEBP"):
+            save_options["quality"] = profile.get("quality", 80)
+        elif image_format == "PNG":
+            save_options["compress_level"] = 1
+
+        buffer = self._frame_buffer
+        buffer.seek(0)
+        buffer.truncate()
+        with self._stage_timer("encode"):
+            image.save(buffer, format=image_format, **save_options)
+        with self._stage_timer("base64"), buffer.getbuffer() as view:
+            return base64.b64encode(view)
+
+    def _get_adapter(self):
+        # Adapters precompile their payload, so keep the current one until the provider,
+        # model or key changes. Returns None for an unknown provider.
+        if self.replay is not None:
+            if self.adapter is None:
+                self.adapter = ReplayAdapter(self.replay, RECORDING_SETTINGS["replay_latency"])
+                self.adapter.log = self.log
+                self.adapter.latency = self.usage_monitor.latency
+            return self.adapter
+        provider, model, api_key = self.provider, self.model, self.api_key
+        tutorial = self.tutorial_content
+        if self.budget_level >= 2:
+            tutorial = tutorial[:BUDGET_SETTINGS["degraded_tutorial_chars"]]
+        adapter = self.adapter
+        if adapter is None or (adapter.name, adapter.model, adapter.api_key, adapter.tutorial) != (provider, model, api_key, tutorial):
+            if provider not in PROVIDER_ADAPTERS:
+                return None
+            if adapter is not None:
+                adapter.close()
+            adapter = self.adapter = self._build_adapter(provider, model, api_key, tutorial)
+        return adapter
+
+    def _get_hedge_adapter(self):
+        # The secondary adapter for hedged requests, or None if it would be the primary itself or lacks a key
+        provider, model, api_key = HEDGE_SETTINGS["provider"], HEDGE_SETTINGS["model"], HEDGE_SETTINGS["api_key"]
+        if (provider, model) == (self.provider, self.model) or provider not in PROVIDER_ADAPTERS:
+            return None
+        if not api_key and provider != "Ollama":
+            return None
+        tutorial = self.adapter.tutorial
+        adapter = self.hedge_adapter
+        if adapter is None or (adapter.name, adapter.model, adapter.tutorial) != (provider, model, tutorial):
+            if adapter is not None:
+                adapter.close()
+            adapter = self.hedge_adapter = self._build_adapter(provider, model, api_key, tutorial)
+        return adapter
+
+    def _build_adapter(self, provider, model, api_key, tutorial):
+        mime_type = IMAGE_MIME_TYPES[self._get_encoding_profile()["format"]]
+        adapter = PROVIDER_ADAPTERS[provider](self.http, model, api_key, tutorial, mime_type)
+        limiter = self.rate_limiters.get((provider, model))
+        if limiter is None:
+            rpm = self.usage_monitor.PRICES.get(model, self.usage_monitor.PRICES["default"])["rpm"]
+            limiter = self.rate_limiters[(provider, model)] = RateLimiter(rpm, RATE_LIMIT_SETTINGS["burst"])
+        adapter.limiter = limiter
+        adapter.log = self.log
+        adapter.latency = self.usage_monitor.latency
+        return adapter
+
+    def _fetch_tutorial(self):
+        if self.replay is not None:
+            # Replays use the tutorial the session was recorded with
+            self.tutorial_content = self.replay.tutorial
+            return
+
+        local_file = TUTORIAL_SETTINGS["local_file"]
+        if local_file and os.path.isfile(local_file):
+            with open(local_file, "r", encoding="utf-8") as f:
+                self.tutorial_content = f.read()
+            self.log(f"✅ Tutorial loaded from local file {local_file}.")
+            return
+
+        cached = self.tutorial_cache.load()
+        if cached is not None:
+            # Start right away from the cached copy; a newer version is picked up by the next run
+            self.tutorial_content = cached
+            self.log("✅ Tutorial loaded from local cache.")
+            if self.tutorial_cache.is_stale():
+                threading.Thread(target=self._revalidate_tutorial, daemon=True).start()
+            return
+
+        self.log("🔗 Loading tutorial from GitHub URL...")
+        try:
+            self.tutorial_content = self.tutorial_cache.refresh()
+            self.log("✅ Tutorial loaded successfully!")
+        except (requests.exceptions.RequestException, OSError) as e:
+            self.log(f"❌ Error loading tutorial: {e}")
+            self.emit("error", message=f"Failed to load tutorial from URL.\nError: {e}")
+
+    def _revalidate_tutorial(self):
+        try:
+            if self.tutorial_cache.refresh() is not None:
+                self.log("🔗 A newer tutorial was downloaded; it will be used from the next run.")
+        except (requests.exceptions.RequestException, OSError) as e:
+            self.log(f"   -> Could not revalidate the cached tutorial: {e}")
+
+    def _execute_actions(self, actions):
+        for action in actions:
+            start = time.perf_counter()
+            t = action.get("type")
+            self.log(f"   - Executing: {t} with {action}")
+            self.emit("action", action=action)
+            if t == "move":
+                x, y = self._to_screen_coords(action)
+                self.input.moveTo(x, y, duration=self.timing["move_duration"])
+            elif t == "click":
+                self.input.click(button=action.get("button", "left"), clicks=action.get("count", 1))
+            elif t == "click_down":
+                self.input.mouseDown(button=action.get("button", "left"))
+            elif t == "click_up":
+                self.input.mouseUp(button=action.get("button", "left"))
+            elif t == "scroll":
+                self.input.scroll(action.get("dy", 0))
+            elif t == "type":
+                self._type_text(action["text"])
+            elif t == "hotkey":
+                self.input.hotkey(*action["keys"])
+            elif t == "speak":
+                text_to_speak = action.get("text", "")
+                if text_to_speak and self.replay is None:
+                    # Played in the background; the agent carries on meanwhile
+                    self.log(f"   - Speaking: {text_to_speak}")
+                    self.speech.speak(text_to_speak)
+            elif t == "multi_click":
+                x, y = self._to_screen_coords(action)
+                for _ in range(action.get("count", 2)):
+                    self.input.click(x, y)
+                    time.sleep(self.timing["click_gap"])
+            elif t == "key_down_for_seconds":
+                key = action.get("key")
+                duration = action.get("duration", 1.0)
+                if key:
+                    self.input.keyDown(key)
+                    self.log(f"   - Holding key: {key} for {duration} seconds")
+                    time.sleep(duration)
+                    self.input.keyUp(key)
+            self.usage_monitor.latency.record("execute", time.perf_counter() - start, self.provider, self.model)
+            with self._stage_timer("settle"):
+                self._settle_after_action()
+
+    def _type_text(self, text):
+        # Long texts go through the clipboard in one paste; typewrite also can't type non-ASCII characters
+        if len(text) >= self.timing["paste_min_chars"] or not text.isascii():
+            try:
+                self._paste_text(text)
+                return
+            except Exception as e:
+                self.log(f"     -> Clipboard unavailable ({e}), typing instead.")
+        self.input.typewrite(text, interval=self.timing["type_interval"])
+
+    def _paste_text(self, text):
+        if pyperclip is None:
+            raise RuntimeError("pyperclip is not installed")
+        try:
+            previous = pyperclip.paste()
+        except pyperclip.PyperclipException:
+            previous = None
+        pyperclip.copy(text)
+        self.input.hotkey("command" if sys.platform == "darwin" else "ctrl", "v")
+        if previous is not None:
+            # Give the target application time to read the clipboard before restoring it. The text
+            # is already pasted, so a failed restore must not make the caller type it a second time.
+            time.sleep(0.2)
+            try:
+                pyperclip.copy(previous)
+            except Exception as e:
+                self.log(f"     -> Could not restore the clipboard: {e}")
+
+    def _settle_after_action(self):
+        if not self.settle_mode:
+            time.sleep(self.timing["action_pause"])
+            return
+        self.stability_detector.wait(self._screen_source, "action", should_stop=lambda: self.stop_flag)
+
+    def _stage_timer(self, stage):
+        return self.usage_monitor.latency.timer(stage, self.provider, self.model)
+
+    def _capture_screenshot(self):
+        with self._stage_timer("capture"):
+            return self._grab_screen()
+
+    def _screen_source(self):
+        if self.replay is not None:
+            return self.replay.frame()
+        return self.desktop().screenshot()
+
+    def _grab_screen(self):
+        screenshot = self._screen_source()
+        # Recorded frames already show the cursor where it was
+        if self.cursor_image and self.replay is None:
+            mouse_x, mouse_y = self.input.position()
+            cursor_copy = self.cursor_image.copy()
+            screen_width, screen_height = self.input.size()
+            ratio = min(screen_width / 1920, screen_height / 1080)
+            new_size = (int(cursor_copy.width * ratio), int(cursor_copy.height * ratio))
+            cursor_copy = cursor_copy.resize(new_size, Image.Resampling.LANCZOS)
+            
+            paste_x = mouse_x - int(cursor_copy.width / 2)
+            paste_y = mouse_y - int(cursor_copy.height / 2)
+            
+            screenshot.paste(cursor_copy, (paste_x, paste_y), cursor_copy)
+        return screenshot
+
+    def _prepare_frames(self, screenshot, user_prompt):
+        # Returns the encoded images and the prompt for this step. In diff mode only the
+        # changed regions are sent at full resolution, plus a small thumbnail for context.
+        # Every image is downscaled and encoded per the provider's profile; frame_regions keeps
+        # the scale of each one so the coordinates in the returned actions can be mapped back.
+        self.encoding_profile = profile = self._get_encoding_profile()
+        # The differ is only marked once the frame is actually submitted.
+        regions = None
+        if self.diff_mode:
+            regions = self.frame_differ.changed_regions(screenshot)
+
+        if not regions:
+            frame, scale = self._fit_to_profile(screenshot, profile)
+            self.frame_regions = [(0, 0, scale)]
+            self.frame_sizes = [frame.size]
+            return [self._encode_image(frame)], user_prompt
+
+        width, height = screenshot.size
+        thumbnail_profile = dict(profile, max_edge=min(self.frame_differ.thumbnail_edge, profile.get("max_edge", width)))
+        thumbnail, scale = self._fit_to_profile(screenshot, thumbnail_profile)
+        images = [self._encode_image(thumbnail)]
+        self.frame_regions = [(0, 0, scale)]
+        self.frame_sizes = [thumbnail.size]
+        notes = [f"Image 1 is a {thumbnail.width}x{thumbnail.height} thumbnail of the whole {width}x{height} screen."]
+
+        for number, (left, top, right, bottom) in enumerate(regions, start=2):
+            crop, scale = self._fit_to_profile(screenshot.crop((left, top, right, bottom)), profile)
+            images.append(self._encode_image(crop))
+            self.frame_regions.append((left, top, scale))
+            self.frame_sizes.append(crop.size)
+            notes.append(f"Image {number} is a {crop.width}x{crop.height} crop of the changed screen region x={left}..{right}, y={top}..{bottom}.")
+
+        notes.append('For "move" and "multi_click", give x/y in the pixels of the image you are pointing into and add "image": <number>. Without "image", x/y refer to image 1.')
+        return images, user_prompt + "\n\n" + "\n".join(notes)
+
+    def _to_screen_coords(self, action):
+        # Map x/y given in the pixels of one of the submitted (possibly downscaled) images
+        # back to absolute screen coordinates. Without "image" they refer to image 1.
+        number = action.get("image", 1)
+        if not isinstance(number, int) or not 1 <= number <= len(self.frame_regions):
+            number = 1
+        left, top, scale = self.frame_regions[number - 1]
+        return round(left + action["x"] / scale), round(top + action["y"] / scale)
+
+    def _wait_for_screen_change(self, screenshot):
+        # Re-poll the screen locally while it looks the same as the last submitted frame,
+        # instead of paying for a model call that would see the same thing again
+        gate = self.frame_gate
+        frame_hash = gate.compute_hash(screenshot)
+        # A replay sends the recorded frames as they were, repeated or not
+        if self.replay is not None or gate.has_changed(frame_hash, screenshot):
+            return screenshot, frame_hash
+
+        self.log("   -> Screen unchanged since last request, waiting for it to change...")
+        deadline = time.time() + gate.max_wait
+        while not self.stop_flag and time.time() < deadline:
+            time.sleep(gate.poll_interval)
+            screenshot = self._capture_screenshot()
+            frame_hash = gate.compute_hash(screenshot)
+            if gate.has_changed(frame_hash, screenshot):
+                # One request for the unchanged frame was avoided, however many polls it took
+                self.usage_monitor.record_skipped_request()
+                self.log("   -> Screen changed.")
+                return screenshot, frame_hash
+
+        if not self.stop_flag:
+            self.log(f"   -> Screen still unchanged after {gate.max_wait:.0f}s, sending anyway.")
+        return screenshot, frame_hash
+
+    def run(self):
+        # Runs one task to the end; blocks until it is complete, stopped or failed
+        self.stop_flag = False
+        self.emit("started", provider=self.provider, model=self.model,
+                  prompt=self.replay.metadata["prompt"] if self.replay is not None else self.prompt.strip(),
+                  replay=self.replay.path if self.replay is not None else None)
+        if self.replay is not None:
+            self.log(f"⏯️ Replaying {len(self.replay.steps)} recorded steps from {self.replay.path}...")
+            self._user_prompt = user_prompt = self.replay.metadata["prompt"]
+            self.input = NullInput(self.replay.frame().size)
+            # Recorded frames don't change while waiting, so there is nothing to settle
+            self._settle_delay = 0
+        else:
+            self.log("▶️ AI agent starting...")
+            self._user_prompt = user_prompt = self.prompt.strip()
+            self.input = self.desktop()
+            self._settle_delay = PIPELINE_SETTINGS["settle_delay"]
+
+        # One pooled session per provider for the whole run, so steps reuse the same connections
+        self.http = ProviderSessions(**HTTP_SETTINGS)
+        self.adapter = None
+
+        self._fetch_tutorial()
+        if not self.tutorial_content:
+            self.log("❌ Failed to load tutorial. Stopping agent.")
+            self.http.close()
+            self._end_replay()
+            self.emit("finished", reason="error", error="Failed to load tutorial.", steps=0, requests=0,
+                      tokens_in=0, tokens_out=0, cost=0.0)
+            self.stop()
+            return
+
+        self.usage_monitor.start_tracking(self.model, user_prompt)
+        self.budget.start_task()
+        self.budget_level = 0
+        self._metrics_exported_at = time.time()
+        self.frame_gate.reset()
+        self.timing = TIMING_PROFILES.get(self.timing_profile, TIMING_PROFILES["human"])
+        self.input.PAUSE = self.timing["pyautogui_pause"]
+        self.frame_differ.reset()
+        self.recorder = None
+        if self.record_mode and self.replay is None:
+            path = os.path.join(RECORDING_SETTINGS["dir"], time.strftime("session-%Y%m%d-%H%M%S.aiport"))
+            metadata = {"provider": self.provider, "model": self.model, "prompt": user_prompt,
+                        "diff_mode": self.diff_mode, "stream_mode": self.stream_mode}
+            try:
+                self.recorder = SessionRecorder(path, metadata, self.tutorial_content, log=self.log, **RECORDING_SETTINGS)
+                self.log(f"⏺️ Recording session to {path}")
+            except OSError as e:
+                self.log(f"   -> Could not start recording: {e}")
+        step_started = time.time()
+        self._last_cached_key = None
+        # Steps of this run as (screen hash, thumbnail, screen actions), saved as a macro if the task completes
+        self._learned_steps = []
+        self._macro_position = 0
+        self.macro = None
+        if self.macro_mode and self.replay is None:
+            self.macro = self.macros.load(user_prompt)
+            if self.macro is not None:
+                self.log(f"🧠 This command succeeded before; replaying its {len(self.macro['steps'])} learned steps while the screen matches.")
+        # (screen hash, tier index) of the last cascaded step, and the tiers that failed this run
+        self._cascade_last = None
+        self._failed_tiers = set()
+        completed = False
+        # Why the loop ended, if not because the task completed or was stopped
+        failure = None
+        steps = 0
+
+        # Capture/encode, inference and execution run as separate stages joined by bounded queues:
+        # this thread does inference, while the workers execute actions and prepare the next frame
+        self._frame_queue = queue.Queue(maxsize=1)
+        self._action_queue = queue.Queue(maxsize=PIPELINE_SETTINGS["action_queue_size"])
+        self._pipeline_stop = threading.Event()
+        self._actions_done = threading.Event()
+        self._actions_done_at = time.time() - self._settle_delay
+        self._actions_done.set()
+        workers = [
+            threading.Thread(target=self._capture_worker, daemon=True),
+            threading.Thread(target=self._execution_worker, daemon=True)
+        ]
+        for worker in workers:
+            worker.start()
+
+        while not self.stop_flag:
+            try:
+                frame = self._next_prepared_frame()
+                if frame is None:
+                    break
+                screenshot, frame_hash, images, step_prompt = frame
+
+                macro_actions = self._next_macro_actions(screenshot, frame_hash)
+                if macro_actions is not None:
+                    self.frame_gate.mark_submitted(frame_hash, screenshot)
+                    self.frame_differ.mark_submitted()
+                    self.last_screenshot = screenshot
+                    self._learn_step(screenshot, frame_hash, macro_actions)
+                    steps += 1
+                    self.emit("step", step=steps, source="macro", model=None, latency=0.0, tokens_in=0, tokens_out=0,
+                              response=None, actions=macro_actions)
+                    if not macro_actions:
+                        self.log("✅ Learned steps completed the task. Stopping.")
+                        completed = True
+                        break
+                    self.log(f"[4] Replaying learned step {self._macro_position} of {len(self.macro['steps'])}:")
+                    # Learned actions are in screen coordinates
+                    self.frame_regions = [(0, 0, 1.0)]
+                    for action in macro_actions:
+                        self._action_queue.put(action)
+                    self._action_queue.put(STEP_END)
+                    continue
+
+                adapter = self._get_adapter()
+                if adapter is None:
+                    self.log("❌ Error: Unsupported API Provider.")
+                    failure = f"Unsupported API provider: {self.provider}"
+                    break
+
+                cache_key = self._response_cache_key(screenshot, adapter, images, step_prompt)
+                cached = None
+                routing = None
+                # If the cached reply was served for this very screen last step, its actions didn't
+                # change anything, so ask the model again
+                if cache_key is not None and cache_key != self._last_cached_key:
+                    cached = self.response_cache.get(cache_key)
+
+                # Replayed responses were paid for when they were recorded
+                if cached is None and self.replay is None:
+                    budget_level = self.budget_level
+                    checked = self._check_budget(screenshot, images, step_prompt)
+                    if checked is None:
+                        failure = "Budget cap reached."
+                        break
+                    adapter, images, step_prompt = checked
+                    if self.budget_level != budget_level:
+                        cache_key = self._response_cache_key(screenshot, adapter, images, step_prompt)
+
+                self.frame_gate.mark_submitted(frame_hash, screenshot)
+                self.frame_differ.mark_submitted()
+                self.last_screenshot = screenshot
+
+                self.log("[2] Sending image and command to AI...")
+
+                parser = None
+                on_text = None
+                if self.stream_mode:
+                    parser = ActionStreamParser()
+                    on_text = lambda delta: self._queue_streamed_actions(parser, delta)
+
+                if cached is not None:
+                    result = ProviderResult(cached["response"], 0, 0, 0.0)
+                    self.usage_monitor.record_response_cache_hit(self.usage_monitor.cost_for(cached["tokens_in"], cached["tokens_out"], model=adapter.model))
+                    self._last_cached_key = cache_key
+                    if on_text is not None:
+                        on_text(result.text)
+                elif self.cascade_mode and self.replay is None:
+                    result, adapter, routing = self._send_cascaded(adapter, images, step_prompt, frame_hash)
+                    self._last_cached_key = None
+                    # Replies were checked before execution, so the chosen one is queued now
+                    if on_text is not None:
+                        on_text(result.text)
+                elif self.hedge_mode and self.replay is None:
+                    result, adapter = self._send_hedged(adapter, images, step_prompt)
+                    self._last_cached_key = None
+                    # Both requests raced unstreamed, so the winner's actions are queued now
+                    if on_text is not None:
+                        on_text(result.text)
+                else:
+                    result = adapter.send(images, step_prompt, on_text=on_text, should_stop=lambda: self.stop_flag)
+                    self._last_cached_key = None
+                    if self.replay is None:
+                        self._record_usage(adapter, result)
+                if cached is None:
+                    # Only replies with actions are cached: a cached "done" could end a fresh run before it starts
+                    if cache_key is not None and self._parsed_actions(result.text, parser):
+                        try:
+                            self.response_cache.put(cache_key, result)
+                        except OSError as e:
+                            self.log(f"   -> Could not cache the response: {e}")
+                response_text = result.text
+                actions = self._parsed_actions(response_text, parser)
+                if actions is not None:
+                    self._learn_step(screenshot, frame_hash, [self._to_screen_action(action) for action in actions])
+                if self.recorder is not None:
+                    self._record_step(screenshot, step_prompt, result, parser, time.time() - step_started, routing)
+                step_started = time.time()
+                steps += 1
+                self.emit("step", step=steps, source="cache" if cached is not None else "model", model=adapter.model,
+                          latency=result.latency, tokens_in=result.tokens_in, tokens_out=result.tokens_out,
+                          response=response_text, actions=actions)
+
+                cache_note = f", {result.cached_tokens} tokens from prompt cache" if result.cached_tokens else ""
+                if cached is not None:
+                    cache_note = ", from response cache"
+                self.log(f"[3] AI response ({result.latency:.2f}s{cache_note}):\n" + response_text)
+
+                if parser is not None and parser.started and not self._unconfirmed_empty(parser):
+                    # Actions were already queued while the response streamed in
+                    if parser.error:
+                        self.log(f"❌ Error parsing JSON or executing: {parser.error}")
+                    elif not parser.done:
+                        self.log("❌ Error parsing JSON or executing: the action list was cut off.")
+                else:
+                    try:
+                        with self._stage_timer("parse"):
+                            actions = self._parse_actions(response_text)
+
+                        if not actions:
+                            self.log("✅ AI thinks the task is complete. Stopping.")
+                            completed = True
+                            break
+
+                        self.log("[4] Executing actions:")
+                        for action in actions:
+                            self._action_queue.put(action)
+                    except Exception as e:
+                        self.log(f"❌ Error parsing JSON or executing: {e}")
+
+                # Once the executor reaches this marker the capture stage starts on the next frame
+                self._action_queue.put(STEP_END)
+
+                if time.time() - self._metrics_exported_at >= METRICS_SETTINGS["export_interval"]:
+                    self._export_metrics()
+
+            except Exception as e:
+                self.log(f"❌ Error in main loop: {e}")
+                failure = str(e)
+                if "API_KEY_INVALID" in str(e) or "AuthenticationError" in str(e):
+                    self.log("ERROR: Invalid API Key. Please check again.")
+                elif "404" in str(e):
+                    self.log("ERROR: API path not found. You might have selected a model that doesn't support screenshots.")
+                    self.log("Please try again with a different model, for example 'gpt-4o'.")
+                break
+                time.sleep(2)
+
+        self._pipeline_stop.set()
+        for worker in workers:
+            worker.join(timeout=2)
+
+        self._export_metrics()
+        if completed and self.macro_mode and self.replay is None and not self.stop_flag:
+            try:
+                self.macros.save(user_prompt, self._learned_steps)
+                self.log(f"🧠 Learned {len(self._learned_steps)} steps for this command.")
+            except OSError as e:
+                self.log(f"   -> Could not save the learned steps: {e}")
+        for kind, stats in self.stability_detector.stats().items():
+            self.log(f"   -> Settle times after each {kind}: p50 {stats['p50']:.2f}s, p95 {stats['p95']:.2f}s, max {stats['max']:.2f}s, {stats['timeouts']} of {stats['count']} timed out")
+
+        stopped = self.stop_flag
+        if stopped:
+             self.log("⏹️ AI stopped by user.")
+        if self.adapter is not None:
+            self.adapter.close()
+            self.adapter = None
+        self._abandon_hedged_requests()
+        if self.hedge_adapter is not None:
+            self.hedge_adapter.close()
+            self.hedge_adapter = None
+        for tier_adapter in self.tier_adapters.values():
+            tier_adapter.close()
+        self.tier_adapters = {}
+        self.http.close()
+        if self.recorder is not None:
+            steps = self.recorder.close()
+            self.log(f"⏺️ Recorded {steps} steps to {self.recorder.path}")
+            self.recorder = None
+        self._end_replay()
+        self._cleanup_temp_files()
+        self.usage_monitor.stop_tracking()
+        monitor = self.usage_monitor
+        self.emit("finished", reason="complete" if completed else "stopped" if stopped else "error", error=failure,
+                  steps=steps, requests=monitor.total_requests, tokens_in=monitor.total_tokens_in, tokens_out=monitor.total_tokens_out,
+                  cost=monitor.cost_for(monitor.total_tokens_in, monitor.total_tokens_out, monitor.total_cached_tokens, monitor.total_cache_write_tokens))
+        self.stop()
+
+    def _end_replay(self):
+        if self.replay is not None:
+            self.replay.close()
+            self.replay = None
+            self.input = None
+
+    def _parse_actions(self, response_text):
+        clean_ai_text = response_text.strip().replace("```json", "").replace("```", "")
+        return json.loads(clean_ai_text)
+
+    def _parsed_actions(self, response_text, parser):
+        # The action list of a reply, or None if it didn't parse
+        if parser is not None and parser.started and not self._unconfirmed_empty(parser):
+            return parser.actions if parser.done and not parser.error else None
+        try:
+            return self._parse_actions(response_text)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _unconfirmed_empty(parser):
+        # A streamed list that closed without any action still has to parse as a whole, since "[step 1]"
+        # in prose closes the same way as a real []
+        return parser.done and not parser.error and not parser.actions
+
+    def _record_usage(self, adapter, result, task_id=None):
+        # Books a finished request. task_id is the task that sent it, for requests that may finish
+        # after their run has ended; those only go into the ledger.
+        cost = self.usage_monitor.update_tokens(result.tokens_in, result.tokens_out, result.cached_tokens, result.cache_write_tokens,
+                                                provider=adapter.name, model=adapter.model, latency=result.latency, task_id=task_id)
+        if self.usage_monitor.is_current(task_id):
+            self.budget.record(result.tokens_in + result.tokens_out, cost)
+            self.usage_monitor.latency.record("inference", result.latency, adapter.name, adapter.model)
+        return cost
+
+    def _hedge_delay(self, adapter):
+        value, count = self.usage_monitor.latency.quantile("inference", HEDGE_SETTINGS["percentile"], adapter.name, adapter.model)
+        if count < HEDGE_SETTINGS["min_samples"]:
+            return HEDGE_SETTINGS["default_delay"]
+        return max(HEDGE_SETTINGS["min_delay"], value)
+
+    def _send_hedged(self, adapter, images, step_prompt):
+        # Sends the request to the primary adapter and, if it is slower than usual, to the hedge
+        # adapter too. Returns (result, adapter) of the first parseable reply, or of the primary if
+        # neither parses. The other request is cancelled but still paid for; its cost is what the
+        # hedge added.
+        hedge = self._get_hedge_adapter()
+        delay = self._hedge_delay(adapter)
+        done = queue.Queue()
+        racing = []
+        frame_sizes = list(self.frame_sizes)
+        task_id = self.usage_monitor.task_id
+
+        def start(target):
+            request = HedgedRequest(target)
+            request.thread = threading.Thread(target=self._hedged_request, args=(request, images, step_prompt, frame_sizes, task_id, done), daemon=True)
+            racing.append(request)
+            self._hedged_requests.append(request)
+            request.thread.start()
+
+        def decide(chosen):
+            # Every request but the chosen one lost; the slower ones are dropped
+            for request in racing:
+                if request is not chosen:
+                    request.cancel.set()
+                    loss = request.settle(lost=True)
+                    if loss is not None:
+                        self.usage_monitor.record_hedge_loss(loss, task_id)
+
+        start(adapter)
+        started = time.perf_counter()
+        pending = 1
+        hedged = False
+        fallback = None
+        while pending:
+            timeout = None
+            if hedge is not None and not hedged:
+                timeout = max(0.0, delay - (time.perf_counter() - started))
+            try:
+                request, result, error = done.get(timeout=timeout)
+            except queue.Empty:
+                self.log(f"   -> No answer from {adapter.model} after {delay:.1f}s, also asking {hedge.model}...")
+                start(hedge)
+                self.usage_monitor.record_hedge()
+                hedged = True
+                pending += 1
+                continue
+            pending -= 1
+            if error is None and self._parsed_actions(result.text, None) is not None:
+                decide(request)
+                if request.adapter is hedge:
+                    self.log(f"   -> {hedge.model} answered first.")
+                    self.usage_monitor.record_hedge_win()
+                return result, request.adapter
+            if request.adapter is adapter or fallback is None:
+                fallback = (request, result, error)
+            # A primary that fails before the hedge delay is handled like any failed request
+            if not hedged:
+                break
+
+        request, result, error = fallback
+        decide(request)
+        if error is not None:
+            raise error
+        return result, request.adapter
+
+    def _hedged_request(self, request, images, step_prompt, frame_sizes, task_id, done):
+        # Streams the reply so the request can be dropped midway once the other one has won.
+        # Usage is booked against task_id even if the reply arrives after the run has ended.
+        adapter = request.adapter
+        received = []
+
+        def on_text(delta):
+            if request.cancel.is_set() or self.stop_flag:
+                raise HedgeCancelled("Request cancelled.")
+            received.append(delta)
+
+        start = time.perf_counter()
+        try:
+            result = adapter.send(images, step_prompt, on_text=on_text, should_stop=lambda: request.cancel.is_set() or self.stop_flag)
+        except HedgeCancelled as e:
+            # The provider still bills what it processed; estimate it. The elapsed time is a lower
+            # bound of this request's latency, which keeps the hedge delay from drifting down.
+            text = "".join(received)
+            cancelled = ProviderResult(text, adapter.estimate_tokens_in(step_prompt, frame_sizes), estimate_text_tokens(text), time.perf_counter() - start)
+            self._settle_hedged(request, self._record_usage(adapter, cancelled, task_id), task_id)
+            done.put((request, None, e))
+            return
+        except Exception as e:
+            self._settle_hedged(request, 0.0, task_id)
+            done.put((request, None, e))
+            return
+        self._settle_hedged(request, self._record_usage(adapter, result, task_id), task_id)
+        done.put((request, result, None))
+
+    def _settle_hedged(self, request, cost, task_id):
+        loss = request.settle(cost=cost)
+        if loss is not None:
+            self.usage_monitor.record_hedge_loss(loss, task_id)
+
+    def _abandon_hedged_requests(self):
+        # Losers still waiting for their reply get a moment to finish; whatever is still running
+        # after that books its usage against its own task when it ends
+        for request in self._hedged_requests:
+            request.cancel.set()
+        deadline = time.time() + 2
+        for request in self._hedged_requests:
+            request.thread.join(timeout=max(0.0, deadline - time.time()))
+        self._hedged_requests = []
+
+    def _cascade_tiers(self, adapter):
+        # Adapters of the cheaper tiers that can be used, followed by the selected model's adapter
+        selected_provider, selected_model = adapter.name, adapter.model
+        tiers = []
+        for tier in CASCADE_SETTINGS["tiers"]:
+            provider, model = tier["provider"], tier["model"]
+            if (provider, model) == (selected_provider, selected_model) or (provider, model) in self._failed_tiers or provider not in PROVIDER_ADAPTERS:
+                continue
+            api_key = tier["api_key"] or (adapter.api_key if provider == selected_provider else "")
+            if not api_key and provider != "Ollama":
+                continue
+            tier_adapter = self.tier_adapters.get((provider, model))
+            if tier_adapter is None or tier_adapter.tutorial != adapter.tutorial:
+                if tier_adapter is not None:
+                    tier_adapter.close()
+                tier_adapter = self.tier_adapters[(provider, model)] = self._build_adapter(provider, model, api_key, adapter.tutorial)
+            tiers.append(tier_adapter)
+        tiers.append(adapter)
+        return tiers
+
+    def _send_cascaded(self, adapter, images, step_prompt, frame_hash):
+        # Tries the tiers from the cheapest up until one gives a usable reply; the last tier's reply
+        # is used whatever it is. Returns (result, adapter, routing decision).
+        tiers = self._cascade_tiers(adapter)
+        start = 0
+        tried = []
+        # The frame gate's thumbnail of this frame, stored when it was marked as submitted
+        thumbnail = self.frame_gate.last_thumbnail
+        if self._cascade_last is not None:
+            last_hash, last_thumbnail, last_index = self._cascade_last
+            if (last_index < len(tiers) - 1 and self.frame_gate.distance(frame_hash, last_hash) < self.frame_gate.threshold
+                    and not self.frame_gate.differs(thumbnail, last_thumbnail)):
+                # The previous step's actions did nothing, so don't ask the same tier again
+                start = last_index + 1
+                tried.append({"model": tiers[last_index].model, "outcome": "unchanged", "cost": 0.0})
+                self.log(f"   -> Screen unchanged after {tiers[last_index].model}'s actions, escalating to {tiers[start].model}.")
+
+        spent = 0.0
+        for index in range(start, len(tiers)):
+            tier = tiers[index]
+            final = index == len(tiers) - 1
+            try:
+                result = tier.send(images, step_prompt, should_stop=lambda: self.stop_flag)
+            except Exception as e:
+                # Cheaper tiers escalate on any failure, including a reply their adapter can't parse
+                if final or self.stop_flag:
+                    raise
+                self._failed_tiers.add((tier.name, tier.model))
+                tried.append({"model": tier.model, "outcome": "error", "cost": 0.0})
+                self.log(f"   -> {tier.model} failed ({e}), skipping it from now on.")
+                continue
+            cost = self._record_usage(tier, result)
+            spent += cost
+            actions = self._parsed_actions(result.text, None)
+            if not isinstance(actions, list):
+                outcome = "parse_error"
+            elif not self._actions_in_bounds(actions):
+                outcome = "out_of_bounds"
+            elif not actions and not final:
+                # Only the selected model may end the task
+                outcome = "done_unconfirmed"
+            else:
+                outcome = "ok"
+            tried.append({"model": tier.model, "outcome": outcome, "cost": cost})
+            if outcome == "ok" or final:
+                break
+            self.log(f"   -> {tier.model} gave an unusable reply ({outcome}), escalating to {tiers[index + 1].model}.")
+
+        self._cascade_last = (frame_hash, thumbnail, index)
+        # What the step would have cost on the last tier alone, with this reply's length
+        top = tiers[-1]
+        baseline = cost if tier is top else self.usage_monitor.cost_for(top.estimate_tokens_in(step_prompt, self.frame_sizes), result.tokens_out, model=top.model)
+        routing = {"served_by": tier.model, "tried": tried, "cost": spent, "saved": baseline - spent}
+        self.usage_monitor.record_routing(routing)
+        if tier is not top:
+            self.log(f"   -> Answered by {tier.model}, ~${routing['saved']:.4f} saved against {top.model}.")
+        return result, tier, routing
+
+    def _actions_in_bounds(self, actions):
+        # False if any x/y lies outside the image it refers to
+        for action in actions:
+            if not isinstance(action, dict) or "x" not in action or "y" not in action:
+                continue
+            number = action.get("image", 1)
+            if not isinstance(number, int) or not 1 <= number <= len(self.frame_sizes):
+                return False
+            width, height = self.frame_sizes[number - 1]
+            x, y = action["x"], action["y"]
+            if not isinstance(x, (int, float)) or not isinstance(y, (int, float)) or not (0 <= x < width and 0 <= y < height):
+                return False
+        return True
+
+    def _next_macro_actions(self, screenshot, frame_hash):
+        # The learned actions for this step if the screen matches the macro's checkpoint;
+        # None hands this and all later steps to the model
+        macro = self.macro
+        if macro is None:
+            return None
+        if self._macro_position < len(macro["steps"]):
+            step = macro["steps"][self._macro_position]
+            if step["size"] == list(screenshot.size) and self._matches_checkpoint(step, screenshot, frame_hash):
+                self._macro_position += 1
+                return step["actions"]
+        self.log(f"   -> Screen differs from learned step {self._macro_position + 1}, asking the model from here.")
+        self.macro = None
+        return None
+
+    def _matches_checkpoint(self, step, screenshot, frame_hash):
+        # Same test as the frame gate: close hashes and no changed pixels in the thumbnails.
+        # Steps learned before thumbnails were stored never match
+        if "thumbnail" not in step or self.frame_gate.distance(frame_hash, int(step["hash"], 16)) >= self.frame_gate.threshold:
+            return False
+        try:
+            with Image.open(io.BytesIO(base64.b64decode(step["thumbnail"]))) as image:
+                learned = np.asarray(image.convert("L"))
+        except (OSError, ValueError):
+            return False
+        return not self.frame_gate.differs(learned, self.frame_gate.thumbnail(screenshot))
+
+    def _learn_step(self, screenshot, frame_hash, actions):
+        buffer = io.BytesIO()
+        Image.fromarray(self.frame_gate.thumbnail(screenshot)).save(buffer, format="PNG")
+        self._learned_steps.append({"hash": f"{frame_hash:x}", "size": list(screenshot.size),
+                                    "thumbnail": base64.b64encode(buffer.getvalue()).decode("ascii"), "actions": actions})
+
+    def _to_screen_action(self, action):
+        # The action with x/y mapped to screen coordinates, so it can be replayed whatever image it pointed into
+        if not isinstance(action, dict) or "x" not in action or "y" not in action:
+            return action
+        screen_action = {key: value for key, value in action.items() if key != "image"}
+        try:
+            screen_action["x"], screen_action["y"] = self._to_screen_coords(action)
+        except (TypeError, ValueError):
+            return action
+        return screen_action
+
+    def _response_cache_key(self, screenshot, adapter, images, step_prompt):
+        # Only whole-frame requests are cached: in diff mode a request also depends on the previous frame
+        if not self.response_cache_mode or self.replay is not None or len(images) != 1:
+            return None
+        return self.response_cache.key(screenshot, step_prompt, adapter.tutorial, adapter.name, adapter.model, self.frame_sizes)
+
+    def _record_step(self, screenshot, step_prompt, result, parser, step_time, routing=None):
+        self.recorder.record_step(screenshot, {
+            "prompt": step_prompt,
+            "response": result.text,
+            "actions": self._parsed_actions(result.text, parser),
+            "frame_regions": self.frame_regions,
+            "latency": result.latency,
+            # Wall time from the previous response to this one: settle, capture, encode and inference
+            "step_time": step_time,
+            "tokens_in": result.tokens_in,
+            "tokens_out": result.tokens_out,
+            "cached_tokens": result.cached_tokens,
+            "routing": routing
+        })
+
+    def _check_budget(self, screenshot, images, step_prompt):
+        # Estimates the request and checks it against the budget, degrading first when close to a
+        # cap. Returns (adapter, images, step_prompt) to send, or None if the agent must stop.
+        while True:
+            adapter = self._get_adapter()
+            tokens_in = adapter.estimate_tokens_in(step_prompt, self.frame_sizes)
+            verdict, cap = self.budget.check(adapter.model, tokens_in, BUDGET_SETTINGS["expected_tokens_out"])
+            if verdict == "stop":
+                self.log(f"⛔ Budget cap {cap} would be exceeded by the next request (~{tokens_in} tokens in). Stopping.")
+                return None
+            if verdict == "ok" or self.budget_level >= 2:
+                return adapter, images, step_prompt
+
+            self.budget_level += 1
+            if self.budget_level == 1:
+                self.log(f"⚠️ Close to budget cap {cap}: sending smaller images from now on.")
+            else:
+                self.log(f"⚠️ Close to budget cap {cap}: also shortening the tutorial from now on.")
+            images, step_prompt = self._prepare_frames(screenshot, self._user_prompt)
+
+    def _export_metrics(self):
+        self._metrics_exported_at = time.time()
+        try:
+            self.usage_monitor.latency.export(METRICS_SETTINGS["export_dir"])
+        except OSError as e:
+            self.log(f"   -> Could not export metrics: {e}")
+
+    def _next_prepared_frame(self):
+        # Blocks until the capture stage hands over the next frame; None once the run is stopping
+        while not self.stop_flag:
+            try:
+                frame = self._frame_queue.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            if isinstance(frame, Exception):
+                raise frame
+            return frame
+        return None
+
+    def _queue_streamed_actions(self, parser, delta):
+        # Called for every streamed text delta; each action goes to the executor as soon as its object is complete
+        for action in parser.feed(delta):
+            if action is parser.actions[0]:
+                self.log("[4] Executing actions as they stream in:")
+            self._action_queue.put(action)
+
+    def _execution_worker(self):
+        failed = False
+        while not self._pipeline_stop.is_set():
+            try:
+                action = self._action_queue.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            if action is STEP_END:
+                failed = False
+                self._actions_done_at = time.time()
+                self._actions_done.set()
+                continue
+            if failed or self.stop_flag:
+                continue
+            try:
+                self._execute_actions([action])
+            except Exception as e:
+                # Skip the rest of this step's actions, same as a failed batch
+                self.log(f"❌ Error parsing JSON or executing: {e}")
+                failed = True
+
+    def _capture_worker(self):
+        while not self._pipeline_stop.is_set():
+            if not self._actions_done.wait(timeout=0.2):
+                continue
+            self._actions_done.clear()
+            try:
+                frame = self._capture_settled_frame(self._actions_done_at + self._settle_delay)
+            except Exception as e:
+                frame = e
+            if frame is None:
+                continue
+            while not self._pipeline_stop.is_set():
+                try:
+                    self._frame_queue.put(frame, timeout=0.2)
+                    break
+                except queue.Full:
+                    continue
+
+    def _capture_settled_frame(self, settle_deadline):
+        # With a fixed settle delay, frames are captured and encoded speculatively while the screen
+        # settles, so the encoded frame is usually ready by the time the delay is over. Work done on
+        # a frame that turned out to be stale is dropped and redone on the latest one.
+        # In adaptive mode the frame is taken as soon as the screen has stopped changing.
+        self.log("\n[1] Taking new screenshot...")
+        speculative = None
+        if self.settle_mode:
+            elapsed, screenshot = self.stability_detector.wait(self._capture_screenshot, "step", should_stop=self._pipeline_stop.is_set)
+            self.log(f"   -> Screen settled after {elapsed:.2f}s")
+            speculative = (screenshot, self._prepare_frames(screenshot, self._user_prompt))
+        else:
+            while not self._pipeline_stop.is_set():
+                screenshot = self._capture_screenshot()
+                if speculative is None or ImageChops.difference(speculative[0], screenshot).getbbox() is not None:
+                    speculative = (screenshot, self._prepare_frames(screenshot, self._user_prompt))
+                remaining = settle_deadline - time.time()
+                if remaining <= 0:
+                    break
+                time.sleep(min(PIPELINE_SETTINGS["speculate_interval"], remaining))
+        if self._pipeline_stop.is_set() or speculative is None:
+            return None
+
+        screenshot, (images, step_prompt) = speculative
+        mouse_x, mouse_y = self.input.position()
+        self.log(f"   -> Mouse position: ({mouse_x}, {mouse_y})")
+
+        settled, frame_hash = self._wait_for_screen_change(screenshot)
+        if self.stop_flag:
+            return None
+        if settled is not screenshot:
+            screenshot = settled
+            images, step_prompt = self._prepare_frames(screenshot, self._user_prompt)
+
+        if len(images) > 1:
+            self.log(f"   -> Sending {len(images) - 1} changed region(s) plus a thumbnail.")
+        return screenshot, frame_hash, images, step_prompt
+
+    def _cleanup_temp_files(self):
+        temp_dir = tempfile.gettempdir()
+        for filename in os.listdir(temp_dir):
+            if filename.startswith("screenshot_") and filename.endswith(".png"):
+                file_path = os.path.join(temp_dir, filename)
+                try:
+                    os.remove(file_path)
+                except OSError as e:
+                    self.log(f"Error deleting temporary file {file_path}: {e}")
+
+# ================== CLI ==================
+def main():
+    parser = argparse.ArgumentParser(description="Run the AIport agent headless; events are printed to stdout as JSON lines.")
+    parser.add_argument("--provider", default=os.environ.get("AIPORT_PROVIDER", "Ollama"), choices=list(PROVIDER_MODELS))
+    parser.add_argument("--model", default=os.environ.get("AIPORT_MODEL"), help="default: the provider's first model")
+    parser.add_argument("--prompt", default=os.environ.get("AIPORT_PROMPT"), help="the command for the AI; '-' reads it from stdin")
+    parser.add_argument("--api-key", default=os.environ.get("AIPORT_API_KEY", ""), help="default: $AIPORT_API_KEY")
+    parser.add_argument("--diff", action="store_true", help="send only changed screen regions")
+    parser.add_argument("--stream", action="store_true", help="stream responses and execute actions as they arrive")
+    parser.add_argument("--settle", action="store_true", help="wait for the screen to settle instead of fixed delays")
+    parser.add_argument("--timing", default="human", choices=list(TIMING_PROFILES), help="action speed")
+    parser.add_argument("--record", action="store_true", help="record the session for replay")
+    parser.add_argument("--cache", action="store_true", help="reuse responses for screens seen before")
+    parser.add_argument("--learn", action="store_true", help="learn the steps of successful runs and replay them for repeated commands")
+    parser.add_argument("--hedge", action="store_true", help=f"hedge slow requests with {HEDGE_SETTINGS['model']}")
+    parser.add_argument("--cascade", action="store_true", help="try cheaper models first and escalate to the selected one")
+    parser.add_argument("--replay", metavar="ARCHIVE", help="replay a recorded session instead of driving the desktop")
+    parser.add_argument("--quiet", action="store_true", help="leave out the \"log\" events")
+    args = parser.parse_args()
+
+    if args.prompt == "-":
+        args.prompt = sys.stdin.read()
+    if args.replay is None:
+        if not (args.prompt or "").strip():
+            parser.error("a prompt is required (--prompt or $AIPORT_PROMPT)")
+        if not args.api_key and args.provider != "Ollama":
+            parser.error(f"{args.provider} needs an API key (--api-key or $AIPORT_API_KEY)")
+
+    output_lock = threading.Lock()
+
+    def print_event(event):
+        if args.quiet and event["event"] == "log":
+            return
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with output_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    finished = {}
+
+    def on_event(event):
+        if event["event"] == "finished":
+            finished.update(event)
+        print_event(event)
+
+    engine = AgentEngine(on_event=on_event)
+    engine.provider = args.provider
+    engine.model = args.model or PROVIDER_MODELS[args.provider][0]
+    engine.api_key = args.api_key
+    engine.prompt = args.prompt or ""
+    engine.diff_mode = args.diff
+    engine.stream_mode = args.stream
+    engine.settle_mode = args.settle
+    engine.timing_profile = args.timing
+    engine.record_mode = args.record
+    engine.response_cache_mode = args.cache
+    engine.macro_mode = args.learn
+    engine.hedge_mode = args.hedge
+    engine.cascade_mode = args.cascade
+    if args.replay:
+        try:
+            engine.replay = ReplaySession(args.replay)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            parser.error(f"could not open the recorded session: {e}")
+        engine.provider = engine.replay.metadata["provider"]
+        engine.model = engine.replay.metadata["model"]
+
+    # The engine runs in a worker so Ctrl+C stops it cleanly instead of killing it mid-action
+    done = threading.Event()
+
+    def run():
+        try:
+            engine.run()
+        finally:
+            done.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    while not done.is_set():
+        try:
+            done.wait(timeout=0.2)
+        except KeyboardInterrupt:
+            engine.stop()
+    engine.usage_monitor.ledger.close()
+
+    if not finished:
+        print_event(dict(event="finished", ts=time.time(), reason="error", error="The engine exited without finishing."))
+    return {"complete": 0, "stopped": 130}.get(finished.get("reason"), 1)
+
+if __name__ == "__main__":
+    sys.exit(main())
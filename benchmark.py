@@ -0,0 +1,395 @@
+import os
+import sys
+import json
+import gzip
+import time
+import types
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import importlib.util
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image, ImageDraw
+
+# Headless benchmark of the agent loop in aiport_engine.py. The real AgentEngine.run runs against
+# a synthetic screen, a no-op input backend in place of pyautogui and a local HTTP server that
+# answers in each provider's wire format, so capture, encoding and request building can be
+# measured on a plain Linux box without a desktop or paid API calls.
+#
+#   python benchmark.py
+#   python benchmark.py --providers OpenAI Claude --steps 30 --latency 0.2 --stream --diff
+#   python benchmark.py --json > bench.json
+
+ENGINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aiport_engine.py")
+
+DEFAULT_MODELS = {
+    "Ollama": "llama3",
+    "Gemini": "gemini-2.5-flash",
+    "OpenRouter": "google/gemini-flash-1.5-preview",
+    "OpenAI": "gpt-4o",
+    "Claude": "claude-3-5-sonnet-20240620"
+}
+
+# ================== FAKE SCREEN AND INPUT ==================
+class FakeScreen:
+    """Synthetic desktop; every input event changes a small part of it, like a real UI would."""
+
+    def __init__(self, width, height, seed=0):
+        rng = random.Random(seed)
+        # Flat background with a few "windows" and lines of "text", which compresses roughly like a real desktop
+        image = Image.new("RGB", (width, height), (32, 96, 160))
+        draw = ImageDraw.Draw(image)
+        for _ in range(6):
+            left, top = rng.randrange(width // 2), rng.randrange(height // 2)
+            right, bottom = left + rng.randrange(300, width // 2), top + rng.randrange(200, height // 2)
+            draw.rectangle((left, top, right, bottom), fill=(245, 245, 245), outline=(90, 90, 90))
+            draw.rectangle((left, top, right, top + 28), fill=(220, 220, 228))
+            for y in range(top + 40, bottom - 10, 18):
+                line_width = rng.randrange(40, max(41, right - left - 20))
+                draw.rectangle((left + 10, y, left + 10 + line_width, y + 8), fill=(60, 60, 60))
+        self.base = image
+        self.events = 0
+
+    def grab(self):
+        image = self.base.copy()
+        # A panel whose position depends on how many input events happened so far. It is large
+        # enough to change the frame hash, like a page or dialog opening after a click.
+        panel_width, panel_height = image.width // 4, image.height // 4
+        x = (self.events * 211) % (image.width - panel_width)
+        y = (self.events * 127) % (image.height - panel_height)
+        ImageDraw.Draw(image).rectangle((x, y, x + panel_width, y + panel_height), fill=(200, 40, 40))
+        return image
+
+def make_input_backend(screen):
+    # Module with the part of the pyautogui API the engine uses; input calls only count as events
+    backend = types.ModuleType("pyautogui")
+    backend.PAUSE = 0.0
+    backend.FAILSAFE = False
+    backend.screenshot = screen.grab
+    backend.position = lambda: (0, 0)
+    backend.size = lambda: screen.base.size
+
+    def event(*args, **kwargs):
+        screen.events += 1
+
+    for name in ("moveTo", "click", "mouseDown", "mouseUp", "scroll", "typewrite", "hotkey", "keyDown", "keyUp"):
+        setattr(backend, name, event)
+    return backend
+
+# ================== SPEECH STAND-INS ==================
+class _Silent:
+    # Accepts any constructor arguments and ignores every method call
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def _stub_module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+def install_stubs():
+    # The engine imports these at module level; none of them should run during a benchmark
+    detector_error = type("LangDetectException", (Exception,), {})
+    modules = {
+        "gtts": _stub_module("gtts", gTTS=_Silent),
+        "playsound": _stub_module("playsound", playsound=lambda path: None),
+        "langdetect": _stub_module("langdetect", detect=lambda text: "en",
+                                   DetectorFactory=types.SimpleNamespace(seed=None),
+                                   lang_detect_exception=types.SimpleNamespace(LangDetectException=detector_error)),
+        # Typed text goes through the no-op typewrite rather than the real clipboard
+        "pyperclip": None
+    }
+    sys.modules.update(modules)
+
+def load_app():
+    spec = importlib.util.spec_from_file_location("aiport_engine", ENGINE_FILE)
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    return app
+
+# ================== PROVIDER STAND-IN ==================
+class ProviderStandIn(ThreadingHTTPServer):
+    """Local server answering like Ollama, Gemini, OpenAI/OpenRouter and Claude."""
+
+    daemon_threads = True
+
+    def __init__(self, latency, response_bytes, steps, chunk_delay):
+        super().__init__(("127.0.0.1", 0), ProviderHandler)
+        self.latency = latency
+        self.response_bytes = response_bytes
+        self.steps = steps
+        self.chunk_delay = chunk_delay
+        self.lock = threading.Lock()
+        self.reset()
+
+    def handle_error(self, request, client_address):
+        # The app closing its pooled keep-alive connections at the end of a run isn't an error
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def reset(self):
+        self.model_requests = 0
+        self.bytes_uploaded = 0
+
+    def next_reply(self):
+        # A click somewhere on the screen per step, padded to response_bytes, then "[]" to end the task
+        with self.lock:
+            self.model_requests += 1
+            step = self.model_requests
+        if step > self.steps:
+            return "[]"
+        actions = [{"type": "move", "x": 50 + step * 7 % 400, "y": 50 + step * 5 % 300}, {"type": "click"}]
+        text = json.dumps(actions)
+        padding = self.response_bytes - len(text) - len(', {"type": "type", "text": ""}')
+        if padding > 0:
+            actions.append({"type": "type", "text": "x" * padding})
+            text = json.dumps(actions)
+        return text
+
+class ProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.bytes_uploaded += len(raw)
+        if self.headers.get("Content-Encoding") == "gzip":
+            raw = gzip.decompress(raw)
+        return json.loads(raw) if raw else {}
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunks(self, content_type, chunks):
+        # Chunked transfer encoding keeps the connection reusable for the next request
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            data = chunk.encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+            if self.server.chunk_delay:
+                time.sleep(self.server.chunk_delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_DELETE(self):
+        self._send_json({})
+
+    def do_POST(self):
+        payload = self._read_body()
+        path = self.path.split("?")[0]
+        if path.endswith("/cachedContents"):
+            self._send_json({"name": "cachedContents/benchmark"})
+            return
+
+        time.sleep(self.server.latency)
+        text = self.server.next_reply()
+        pieces = [text[i:i + 16] for i in range(0, len(text), 16)] or [""]
+        tokens_in = int(self.headers.get("Content-Length", 0)) // 4
+        tokens_out = max(1, len(text) // 4)
+
+        if path == "/api/generate":
+            if payload.get("stream"):
+                lines = [json.dumps({"response": piece, "done": False}) + "\n" for piece in pieces]
+                lines.append(json.dumps({"response": "", "done": True, "prompt_eval_count": tokens_in, "eval_count": tokens_out}) + "\n")
+                self._send_chunks("application/x-ndjson", lines)
+            else:
+                self._send_json({"response": text, "done": True, "prompt_eval_count": tokens_in, "eval_count": tokens_out})
+        elif ":streamGenerateContent" in path:
+            events = [f'data: {json.dumps({"candidates": [{"content": {"parts": [{"text": piece}]}}]})}\n\n' for piece in pieces]
+            events.append(f'data: {json.dumps({"candidates": [{"content": {"parts": []}}], "usageMetadata": {"promptTokenCount": tokens_in, "candidatesTokenCount": tokens_out}})}\n\n')
+            self._send_chunks("text/event-stream", events)
+        elif ":generateContent" in path:
+            self._send_json({"candidates": [{"content": {"parts": [{"text": text}]}}], "usageMetadata": {"promptTokenCount": tokens_in, "candidatesTokenCount": tokens_out}})
+        elif path.endswith("/chat/completions"):
+            usage = {"prompt_tokens": tokens_in, "completion_tokens": tokens_out}
+            if payload.get("stream"):
+                events = [f'data: {json.dumps({"choices": [{"delta": {"content": piece}}]})}\n\n' for piece in pieces]
+                events.append(f'data: {json.dumps({"choices": [], "usage": usage})}\n\n')
+                events.append("data: [DONE]\n\n")
+                self._send_chunks("text/event-stream", events)
+            else:
+                self._send_json({"choices": [{"message": {"content": text}}], "usage": usage})
+        elif path.endswith("/messages"):
+            if payload.get("stream"):
+                events = [("message_start", {"type": "message_start", "message": {"usage": {"input_tokens": tokens_in}}})]
+                events += [("content_block_delta", {"type": "content_block_delta", "delta": {"type": "text_delta", "text": piece}}) for piece in pieces]
+                events.append(("message_delta", {"type": "message_delta", "usage": {"output_tokens": tokens_out}}))
+                events.append(("message_stop", {"type": "message_stop"}))
+                self._send_chunks("text/event-stream", [f"event: {name}\ndata: {json.dumps(data)}\n\n" for name, data in events])
+            else:
+                self._send_json({"content": [{"type": "text", "text": text}], "usage": {"input_tokens": tokens_in, "output_tokens": tokens_out}})
+        else:
+            self.send_error(404)
+
+# ================== BENCHMARK ==================
+def configure_app(app, args, workdir):
+    # Keep everything the run writes inside the temporary directory
+    tutorial_path = os.path.join(workdir, "tutorial.txt")
+    with open(tutorial_path, "w", encoding="utf-8") as f:
+        sentence = "When the user asks to open an application, find its icon and double click it. "
+        f.write(sentence * max(1, args.tutorial_bytes // len(sentence)))
+    app.TUTORIAL_SETTINGS["local_file"] = tutorial_path
+    app.USAGE_LEDGER_PATH = os.path.join(workdir, "usage.db")
+    app.LEGACY_USAGE_PATH = None
+    app.METRICS_SETTINGS["export_dir"] = os.path.join(workdir, "metrics")
+    app.SPEECH_SETTINGS["cache_dir"] = os.path.join(workdir, "speech")
+    app.RESPONSE_CACHE_SETTINGS["dir"] = os.path.join(workdir, "responses")
+    app.MACRO_SETTINGS["dir"] = os.path.join(workdir, "macros")
+    for cap in ("task_tokens", "task_cost", "day_tokens", "day_cost"):
+        app.BUDGET_SETTINGS[cap] = None
+    app.PIPELINE_SETTINGS["settle_delay"] = args.settle_delay
+    if args.record:
+        app.RECORDING_SETTINGS["dir"] = args.record
+    if args.gzip:
+        app.HTTP_SETTINGS["compress"] = list(app.PROVIDER_ADAPTERS)
+
+def make_agent(app, provider, model, args, screen=None):
+    errors = []
+
+    def on_event(event):
+        if event["event"] == "error" or (event["event"] == "log" and "❌" in event["message"]):
+            errors.append(event["message"])
+
+    agent = app.AgentEngine(on_event=on_event, input_backend=make_input_backend(screen) if screen else None)
+    agent.cursor_image = None
+    cursor_path = os.path.join(os.path.dirname(ENGINE_FILE), "cursor.png")
+    if os.path.exists(cursor_path):
+        agent.cursor_image = Image.open(cursor_path).convert("RGBA")
+    agent.provider = provider
+    agent.model = model
+    agent.api_key = "benchmark"
+    agent.prompt = "Open the browser and search for the weather"
+    agent.diff_mode = args.diff
+    agent.stream_mode = args.stream
+    agent.timing_profile = "instant"
+    if not args.respect_rpm:
+        for prices in agent.usage_monitor.PRICES.values():
+            prices["rpm"] = None
+    agent.record_mode = bool(args.record)
+    # Every run would otherwise replay the learned steps of the first one
+    agent.macro_mode = False
+    agent.errors = errors
+    return agent
+
+def run_agent(agent):
+    start = time.perf_counter()
+    agent.run()
+    elapsed = time.perf_counter() - start
+    agent.usage_monitor.ledger.close()
+    return elapsed
+
+def make_result(agent, provider, model, steps, elapsed, bytes_uploaded_per_step):
+    # Replays time the adapter stages under "Replay" and the rest under the recorded provider
+    stages = {entry["stage"]: entry for entry in agent.usage_monitor.latency.snapshot() if entry["provider"] in (provider, "Replay")}
+    return {
+        "provider": provider,
+        "model": model,
+        "steps": steps,
+        "seconds": elapsed,
+        "steps_per_sec": steps / elapsed if elapsed > 0 else 0.0,
+        "bytes_uploaded_per_step": bytes_uploaded_per_step,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": {stage: {key: entry[key] for key in ("count", "p50", "p95", "p99")} for stage, entry in stages.items()},
+        "errors": agent.errors
+    }
+
+def run_provider(app, screen, server, provider, model, args):
+    server.reset()
+    screen.events = 0
+    app.HTTP_SETTINGS["base_urls"] = {name: server.url for name in app.PROVIDER_ADAPTERS}
+
+    agent = make_agent(app, provider, model, args, screen)
+    elapsed = run_agent(agent)
+    # The final request only returns "[]", so it isn't a full step
+    steps = max(0, server.model_requests - 1)
+    return make_result(agent, provider, model, steps, elapsed, server.bytes_uploaded / max(1, server.model_requests))
+
+def run_replay(app, path, args):
+    # Feeds a recorded session through the loop: no stand-in server and no input events involved
+    session = app.ReplaySession(path)
+    provider, model = session.metadata["provider"], session.metadata["model"]
+    agent = make_agent(app, provider, model, args)
+    agent.replay = session
+    elapsed = run_agent(agent)
+    steps = sum(1 for step in session.steps[:session.position] if step["actions"])
+    return make_result(agent, provider, model, steps, elapsed, 0.0)
+
+def print_report(results):
+    stage_order = ["capture", "encode", "base64", "render", "request", "response", "inference", "parse", "execute", "settle"]
+    for result in results:
+        print(f"\n{result['provider']} ({result['model']}): {result['steps']} steps in {result['seconds']:.2f}s")
+        print(f"  steps/sec            {result['steps_per_sec']:.2f}")
+        print(f"  uploaded/step        {result['bytes_uploaded_per_step'] / 1024:.1f} KiB")
+        print(f"  peak RSS (process)   {result['peak_rss_mb']:.1f} MiB")
+        print(f"  {'stage':<10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'count':>7}")
+        for stage in stage_order:
+            entry = result["stages"].get(stage)
+            if entry:
+                print(f"  {stage:<10} {entry['p50'] * 1000:>9.2f} {entry['p95'] * 1000:>9.2f} {entry['p99'] * 1000:>9.2f} {entry['count']:>7}")
+        for error in result["errors"][:5]:
+            print(f"  {error}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmark of the AIport agent loop.")
+    parser.add_argument("--providers", nargs="+", default=list(DEFAULT_MODELS), choices=list(DEFAULT_MODELS))
+    parser.add_argument("--steps", type=int, default=20, help="steps per provider before the stand-in ends the task")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stand-in waits before answering")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--response-bytes", type=int, default=200, help="approximate size of each reply's action list")
+    parser.add_argument("--resolution", default="1920x1080")
+    parser.add_argument("--tutorial-bytes", type=int, default=20000)
+    parser.add_argument("--settle-delay", type=float, default=0.0, help="overrides PIPELINE_SETTINGS['settle_delay']")
+    parser.add_argument("--diff", action="store_true", help="send only changed regions")
+    parser.add_argument("--stream", action="store_true", help="stream replies")
+    parser.add_argument("--gzip", action="store_true", help="gzip request bodies for every provider")
+    parser.add_argument("--respect-rpm", action="store_true", help="keep the per-model RPM limits")
+    parser.add_argument("--record", metavar="DIR", help="record each run as a session archive in DIR")
+    parser.add_argument("--replay", metavar="ARCHIVE", nargs="+", help="replay recorded sessions instead of running the providers")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    width, height = (int(value) for value in args.resolution.lower().split("x"))
+    screen = FakeScreen(width, height)
+    install_stubs()
+    app = load_app()
+
+    server = ProviderStandIn(args.latency, args.response_bytes, args.steps, args.chunk_delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_app(app, args, workdir)
+        for path in args.replay or []:
+            results.append(run_replay(app, path, args))
+        for provider in [] if args.replay else args.providers:
+            results.append(run_provider(app, screen, server, provider, DEFAULT_MODELS[provider], args))
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+if __name__ == "__main__":
+    main()